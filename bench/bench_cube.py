@@ -0,0 +1,225 @@
+import gc
+import json
+import sys
+
+try:
+    from time import ticks_diff, ticks_us
+except ImportError:
+    from time import perf_counter
+
+    def ticks_us():
+        return int(perf_counter() * 1000000)
+
+    def ticks_diff(end, start):
+        return end - start
+
+
+try:
+    BENCH_DIR = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+except NameError:
+    BENCH_DIR = "bench"
+sys.path.insert(0, BENCH_DIR + "/../src")
+
+from cube import Cube  # noqa: E402
+
+IMPLEMENTATION = sys.implementation.name
+BASELINE_FILE = "%s/baseline-%s.json" % (BENCH_DIR, IMPLEMENTATION)
+DEFAULT_THRESHOLD = 0.2
+# Each sample repeats a workload for at least MIN_SAMPLE_US, and the median
+# of the samples is reported: single passes are too short to be stable
+REPEATS = 11
+MIN_SAMPLE_US = 100000
+
+# Whole-cube rotations performed by the Hub while scanning the faces in
+# the order L, F, D, R, B, U; the colors of the top face are read after
+# each group
+SCAN_SEQUENCE = [
+    ["z"],
+    ["y", "z"],
+    ["y'", "z"],
+    ["y", "z"],
+    ["y'", "z"],
+    ["y", "z"],
+]
+SCAN_COLORS = [
+    "OOOOOOOOO",
+    "GGGGGGGGG",
+    "YYYYYYYYY",
+    "RRRRRRRRR",
+    "BBBBBBBBB",
+    "WWWWWWWWW",
+]
+
+FACE_MOVES = [f + v for f in Cube.FACES for v in ["", "'", "2"]]
+ROTATIONS = ["", "x", "x'", "x2", "y", "y'", "y2", "z", "z'", "z2"]
+
+
+class Random:
+    # Park-Miller generator: produces the same workloads under CPython and
+    # MicroPython, which do not share a random module implementation
+    def __init__(self, seed=12345):
+        self.state = seed
+
+    def next(self, n):
+        self.state = (self.state * 16807) % 2147483647
+        return self.state % n
+
+
+def random_solution(rnd, length=20):
+    moves = []
+    while len(moves) < length:
+        move = FACE_MOVES[rnd.next(len(FACE_MOVES))]
+        if moves and moves[-1][0] == move[0]:
+            continue
+        moves.append(move)
+    return " ".join(moves)
+
+
+def random_states(rnd, count):
+    states = []
+    for _ in range(count):
+        cube = Cube()
+        cube.apply(random_solution(rnd))
+        states.append(str(cube))
+    return states
+
+
+def make_workloads():
+    rnd = Random()
+    states = random_states(rnd, 20)
+    solutions = [random_solution(rnd) for _ in range(20)]
+    rotated = []
+    for conf in states:
+        cube = Cube(conf)
+        rotation = ROTATIONS[rnd.next(len(ROTATIONS))]
+        if rotation:
+            cube.apply(rotation)
+        rotated.append(str(cube))
+    return states, solutions, rotated
+
+
+def bench_init(states, solutions, rotated):
+    for conf in states:
+        Cube(conf)
+    return len(states)
+
+
+def bench_scan(states, solutions, rotated):
+    cube = Cube()
+    for moves, colors in zip(SCAN_SEQUENCE, SCAN_COLORS):
+        for move in moves:
+            cube.apply(move)
+        cube.assign_colors_top_face(colors)
+    cube.reset_orientation()
+    return 1
+
+
+def bench_apply(states, solutions, rotated):
+    cube = Cube()
+    for solution in solutions:
+        cube.apply(solution)
+    return len(solutions)
+
+
+def bench_apply_one_transformation(states, solutions, rotated):
+    cube = Cube()
+    for _ in range(10):
+        for move in FACE_MOVES:
+            if not move.endswith("2"):
+                cube._apply_one_transformation(move)
+    return 120
+
+
+def bench_bring_to_canonical(states, solutions, rotated):
+    for conf in rotated:
+        Cube(conf).bring_to_canonical()
+    return len(rotated)
+
+
+def bench_get_cube_in_canonical_orientation(states, solutions, rotated):
+    for conf in rotated:
+        Cube(conf).get_cube_in_canonical_orientation()
+    return len(rotated)
+
+
+def bench_str(states, solutions, rotated):
+    cube = Cube(states[0])
+    for _ in range(200):
+        str(cube)
+    return 200
+
+
+BENCHMARKS = [
+    ("init", bench_init),
+    ("scan", bench_scan),
+    ("apply_20_moves", bench_apply),
+    ("apply_one_transformation", bench_apply_one_transformation),
+    ("bring_to_canonical", bench_bring_to_canonical),
+    ("get_cube_in_canonical_orientation", bench_get_cube_in_canonical_orientation),
+    ("str", bench_str),
+]
+
+
+def run_sample(fn, workloads):
+    gc.collect()
+    ops = 0
+    start = ticks_us()
+    while True:
+        ops += fn(*workloads)
+        elapsed = ticks_diff(ticks_us(), start)
+        if elapsed >= MIN_SAMPLE_US:
+            return elapsed / ops
+
+
+def run_benchmark(fn, workloads):
+    samples = sorted(run_sample(fn, workloads) for _ in range(REPEATS))
+    return samples[len(samples) // 2]
+
+
+def load_baseline():
+    try:
+        with open(BASELINE_FILE) as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+def save_baseline(results):
+    with open(BASELINE_FILE, "w") as f:
+        json.dump(results, f)
+    print("Baseline saved to %s" % BASELINE_FILE)
+
+
+def main(args):
+    threshold = DEFAULT_THRESHOLD
+    if "--threshold" in args:
+        threshold = float(args[args.index("--threshold") + 1])
+
+    workloads = make_workloads()
+    baseline = load_baseline()
+    results = {}
+    regressions = 0
+    print("Cube benchmarks (%s)" % IMPLEMENTATION)
+    print("--------------------------------------------------------------")
+    for name, fn in BENCHMARKS:
+        results[name] = run_benchmark(fn, workloads)
+        line = "%-35s %10.1f us" % (name, results[name])
+        if baseline and name in baseline:
+            change = results[name] / baseline[name] - 1
+            line += "  %+6.1f%%" % (100 * change)
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions += 1
+        print(line)
+    print("--------------------------------------------------------------")
+
+    if "--save" in args:
+        save_baseline(results)
+    elif baseline is None:
+        print("No baseline for %s: run with --save to store one" % IMPLEMENTATION)
+    if regressions:
+        print("Regressions:", regressions)
+        sys.exit(1)
+
+
+main(sys.argv[1:])
@@ -0,0 +1,204 @@
+import atexit
+import cv2
+import numpy as np
+import queue
+import threading
+import time
+
+from os import path
+
+
+class CaptureWriter:
+    FORMATS = {"raw", "png", "dataset"}
+
+    def __init__(
+        self,
+        folder="images",
+        fmt="png",
+        png_compression=1,
+        max_pending=8,
+        dataset_name="captures",
+        run=None,
+    ):
+        if fmt not in CaptureWriter.FORMATS:
+            raise ValueError("Invalid capture format '%s'" % fmt)
+        self.folder = folder
+        self.fmt = fmt
+        self.png_compression = png_compression
+        self.dataset_name = dataset_name
+        self.run = run or time.strftime("%Y%m%d-%H%M%S")
+        self.dataset = None
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, img_name, orig_face, square_face):
+        if self.thread is None:
+            raise Exception("Capture writer is closed")
+        # Blocks when the queue is full, so a slow disk throttles the
+        # command loop instead of piling up frames in memory
+        self.pending.put((img_name, time.time(), orig_face, square_face))
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.pending.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.dataset:
+            self.dataset.close()
+            self.dataset = None
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                print("❗Cannot save capture %s: %s" % (item[0], e))
+
+    def _write(self, img_name, timestamp, orig_face, square_face):
+        if self.fmt == "png":
+            params = [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+            cv2.imwrite(
+                path.join(self.folder, "%s-orig.png" % img_name), orig_face, params
+            )
+            cv2.imwrite(
+                path.join(self.folder, "%s-square.png" % img_name), square_face, params
+            )
+        elif self.fmt == "raw":
+            np.save(path.join(self.folder, "%s-orig.npy" % img_name), orig_face)
+            np.save(path.join(self.folder, "%s-square.npy" % img_name), square_face)
+        else:
+            self._append_dataset(img_name, timestamp, orig_face, square_face)
+
+    def _append_dataset(self, img_name, timestamp, orig_face, square_face):
+        if self.dataset is None:
+            self.dataset = CaptureDataset(self.folder, self.dataset_name)
+        self.dataset.append(
+            self.run,
+            CaptureDataset.face_from_name(img_name),
+            timestamp,
+            orig_face,
+            square_face,
+        )
+        self.dataset.flush()
+
+
+class CaptureDataset:
+    ORIG_SHAPE = (480, 640, 3)
+    SQUARE_SHAPE = (300, 300, 3)
+    FACES = ["U", "R", "F", "D", "L", "B"]
+
+    def __init__(self, folder="images", name="captures"):
+        self.base = path.join(folder, name)
+        self.append_files = None
+        self.append_run = None
+        self.load()
+
+    @staticmethod
+    def face_from_name(img_name):
+        return img_name[len("face_") :] if img_name.startswith("face_") else img_name
+
+    def load(self):
+        self.index = []
+        if path.exists(self.base + ".index"):
+            with open(self.base + ".index") as f:
+                for line in f:
+                    run, face, timestamp, labels = line.rstrip("\n").split("\t")
+                    self.index.append((run, face, float(timestamp), labels))
+        self.orig_frames = self._map_frames("-orig.frames", CaptureDataset.ORIG_SHAPE)
+        self.square_frames = self._map_frames(
+            "-square.frames", CaptureDataset.SQUARE_SHAPE
+        )
+
+    def _map_frames(self, suffix, shape):
+        if not self.index:
+            return np.empty((0,) + shape, dtype=np.uint8)
+        return np.memmap(
+            self.base + suffix,
+            dtype=np.uint8,
+            mode="r",
+            shape=(len(self.index),) + shape,
+        )
+
+    def __len__(self):
+        return len(self.index)
+
+    def runs(self):
+        return list(dict.fromkeys(run for (run, _, _, _) in self.index))
+
+    def run_slice(self, run):
+        # Frames are appended one run at a time, so a run is a contiguous
+        # block and slicing the memory maps with it does not copy anything
+        positions = [i for (i, entry) in enumerate(self.index) if entry[0] == run]
+        if not positions:
+            raise ValueError("Unknown run '%s'" % run)
+        if positions[-1] - positions[0] + 1 != len(positions):
+            raise ValueError("Run '%s' is not contiguous" % run)
+        return slice(positions[0], positions[-1] + 1)
+
+    def find(self, run, face):
+        for (i, entry) in enumerate(self.index):
+            if entry[0] == run and entry[1] == face:
+                return i
+        raise ValueError("No capture of face %s in run '%s'" % (face, run))
+
+    def append(self, run, face, timestamp, orig_face, square_face, labels=""):
+        if orig_face.shape != CaptureDataset.ORIG_SHAPE:
+            raise ValueError("Invalid frame shape %s" % (orig_face.shape,))
+        if square_face.shape != CaptureDataset.SQUARE_SHAPE:
+            raise ValueError("Invalid frame shape %s" % (square_face.shape,))
+        if run != self.append_run:
+            # Runs already in the dataset cannot be extended: their frames
+            # would no longer be contiguous
+            if any(entry[0] == run for entry in self.index):
+                raise ValueError("Run '%s' already exists" % run)
+            self.append_run = run
+        if self.append_files is None:
+            self.append_files = (
+                open(self.base + "-orig.frames", "ab"),
+                open(self.base + "-square.frames", "ab"),
+                open(self.base + ".index", "a"),
+            )
+        orig_file, square_file, index_file = self.append_files
+        orig_file.write(np.ascontiguousarray(orig_face, dtype=np.uint8).tobytes())
+        square_file.write(np.ascontiguousarray(square_face, dtype=np.uint8).tobytes())
+        index_file.write("%s\t%s\t%f\t%s\n" % (run, face, timestamp, labels))
+
+    def flush(self):
+        if self.append_files:
+            for f in self.append_files:
+                f.flush()
+
+    def close(self):
+        if self.append_files:
+            for f in self.append_files:
+                f.close()
+            self.append_files = None
+        self.load()
+
+    def import_folder(self, folder, run=None):
+        run = run or path.basename(path.normpath(folder))
+        if run in self.runs():
+            raise ValueError("Run '%s' already exists" % run)
+        for face in CaptureDataset.FACES:
+            img_name = "face_%s" % face
+            orig_file = path.join(folder, "%s-orig.png" % img_name)
+            square_file = path.join(folder, "%s-square.png" % img_name)
+            class_file = path.join(folder, "%s-class.txt" % img_name)
+            if not path.exists(orig_file):
+                continue
+            labels = open(class_file).read().strip() if path.exists(class_file) else ""
+            self.append(
+                run,
+                face,
+                path.getmtime(orig_file),
+                cv2.imread(orig_file),
+                cv2.imread(square_file),
+                labels,
+            )
+        self.close()
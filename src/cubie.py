@@ -0,0 +1,119 @@
+from cube import Cube
+
+
+def _facelet(name):
+    return Cube.FACES.index(name[0]) * Cube.FACE_SIZE + int(name[1]) - 1
+
+
+class Cubies:
+    NUM_CORNERS = 8
+    NUM_EDGES = 12
+    NUM_SLOTS = 24
+
+    # Facelets of each corner and edge position, listed so that the first one
+    # lies on the U or D face (or on F/B for the middle layer edges)
+    # fmt: off
+    CORNER_FACELETS = [
+        [_facelet(f) for f in c] for c in [
+            ["U9", "R1", "F3"], ["U7", "F1", "L3"], ["U1", "L1", "B3"],
+            ["U3", "B1", "R3"], ["D3", "F9", "R7"], ["D1", "L9", "F7"],
+            ["D7", "B9", "L7"], ["D9", "R9", "B7"],
+        ]
+    ]
+    EDGE_FACELETS = [
+        [_facelet(f) for f in e] for e in [
+            ["U6", "R2"], ["U8", "F2"], ["U4", "L2"], ["U2", "B2"],
+            ["D6", "R8"], ["D2", "F8"], ["D4", "L8"], ["D8", "B8"],
+            ["F6", "R4"], ["F4", "L6"], ["B6", "L4"], ["B4", "R6"],
+        ]
+    ]
+    # fmt: on
+    CORNER_COLORS = [
+        [Cube.FACES[f // Cube.FACE_SIZE] for f in c] for c in CORNER_FACELETS
+    ]
+    EDGE_COLORS = [
+        [Cube.FACES[f // Cube.FACE_SIZE] for f in e] for e in EDGE_FACELETS
+    ]
+
+    MOVES = [f + v for f in Cube.FACES for v in ["", "2", "'"]]
+
+    @staticmethod
+    def from_facelets(conf):
+        # Returns the slot (position * 3 + orientation for corners,
+        # position * 2 + orientation for edges) of every cubie
+        corners = [None] * Cubies.NUM_CORNERS
+        for pos, facelets in enumerate(Cubies.CORNER_FACELETS):
+            colors = [conf[f] for f in facelets]
+            for ori in range(0, 3):
+                if colors[ori] in ("U", "D"):
+                    break
+            else:
+                raise ValueError("Invalid corner at position %d" % pos)
+            twisted = [colors[(ori + i) % 3] for i in range(0, 3)]
+            if twisted not in Cubies.CORNER_COLORS:
+                raise ValueError("Invalid corner at position %d" % pos)
+            corners[Cubies.CORNER_COLORS.index(twisted)] = pos * 3 + ori
+
+        edges = [None] * Cubies.NUM_EDGES
+        for pos, facelets in enumerate(Cubies.EDGE_FACELETS):
+            colors = [conf[f] for f in facelets]
+            if colors in Cubies.EDGE_COLORS:
+                edges[Cubies.EDGE_COLORS.index(colors)] = pos * 2
+            elif colors[::-1] in Cubies.EDGE_COLORS:
+                edges[Cubies.EDGE_COLORS.index(colors[::-1])] = pos * 2 + 1
+            else:
+                raise ValueError("Invalid edge at position %d" % pos)
+
+        if None in corners or None in edges:
+            raise ValueError("Invalid cube '%s'" % conf)
+        return corners, edges
+
+    @staticmethod
+    def to_facelets(corners, edges):
+        conf = [Cube.FACES[i // Cube.FACE_SIZE] for i in range(0, Cube.NUM_FACELETS)]
+        for cubie, slot in enumerate(corners):
+            pos, ori = divmod(slot, 3)
+            for i in range(0, 3):
+                facelet = Cubies.CORNER_FACELETS[pos][(ori + i) % 3]
+                conf[facelet] = Cubies.CORNER_COLORS[cubie][i]
+        for cubie, slot in enumerate(edges):
+            pos, ori = divmod(slot, 2)
+            for i in range(0, 2):
+                facelet = Cubies.EDGE_FACELETS[pos][(ori + i) % 2]
+                conf[facelet] = Cubies.EDGE_COLORS[cubie][i]
+        return "".join(conf)
+
+    @staticmethod
+    def _build_move_tables():
+        corner_moves = []
+        edge_moves = []
+        for move in Cubies.MOVES:
+            cube = Cube()
+            cube.apply(move)
+            corners, edges = Cubies.from_facelets(str(cube))
+            # A cubie at position p is taken where the move takes the solved
+            # cubie p, and picks up the same twist (or flip) on the way
+            corner_table = [None] * Cubies.NUM_SLOTS
+            for p, slot in enumerate(corners):
+                q, twist = divmod(slot, 3)
+                for ori in range(0, 3):
+                    corner_table[p * 3 + ori] = q * 3 + (ori + twist) % 3
+            edge_table = [None] * Cubies.NUM_SLOTS
+            for p, slot in enumerate(edges):
+                q, flip = divmod(slot, 2)
+                for ori in range(0, 2):
+                    edge_table[p * 2 + ori] = q * 2 + (ori + flip) % 2
+            corner_moves.append(bytes(corner_table))
+            edge_moves.append(bytes(edge_table))
+        return corner_moves, edge_moves
+
+    @staticmethod
+    def apply(corners, edges, move):
+        m = Cubies.MOVES.index(move)
+        return (
+            [Cubies.CORNER_MOVES[m][s] for s in corners],
+            [Cubies.EDGE_MOVES[m][s] for s in edges],
+        )
+
+
+Cubies.CORNER_MOVES, Cubies.EDGE_MOVES = Cubies._build_move_tables()
@@ -1,46 +1,12 @@
-import re
 import hub
+import uasyncio
 
 from mindstorms import DistanceSensor, MSHub, Motor
-from mindstorms.control import wait_for_seconds, wait_until
-from mindstorms.operator import equal_to
-
-CUBE_PRINT_LETTERS_TEMPLATE = """\
-          +---------+
-          | %(U1)s  %(U2)s  %(U3)s |
-          | %(U4)s  %(U5)s  %(U6)s |
-          | %(U7)s  %(U8)s  %(U9)s |
-+---------+---------+---------+---------+
-| %(L1)s  %(L2)s  %(L3)s | %(F1)s  %(F2)s  %(F3)s | %(R1)s  %(R2)s  %(R3)s | %(B1)s  %(B2)s  %(B3)s |
-| %(L4)s  %(L5)s  %(L6)s | %(F4)s  %(F5)s  %(F6)s | %(R4)s  %(R5)s  %(R6)s | %(B4)s  %(B5)s  %(B6)s |
-| %(L7)s  %(L8)s  %(L9)s | %(F7)s  %(F8)s  %(F9)s | %(R7)s  %(R8)s  %(R9)s | %(B7)s  %(B8)s  %(B9)s |
-+---------+---------+---------+---------+
-          | %(D1)s  %(D2)s  %(D3)s |
-          | %(D4)s  %(D5)s  %(D6)s |
-          | %(D7)s  %(D8)s  %(D9)s |
-          +---------+\
-"""
-
-CUBE_PRINT_COLORS_TEMPLATE = """\
-      %(U1)s%(U2)s%(U3)s
-      %(U4)s%(U5)s%(U6)s
-      %(U7)s%(U8)s%(U9)s
-%(L1)s%(L2)s%(L3)s%(F1)s%(F2)s%(F3)s%(R1)s%(R2)s%(R3)s%(B1)s%(B2)s%(B3)s
-%(L4)s%(L5)s%(L6)s%(F4)s%(F5)s%(F6)s%(R4)s%(R5)s%(R6)s%(B4)s%(B5)s%(B6)s
-%(L7)s%(L8)s%(L9)s%(F7)s%(F8)s%(F9)s%(R7)s%(R8)s%(R9)s%(B7)s%(B8)s%(B9)s
-      %(D1)s%(D2)s%(D3)s
-      %(D4)s%(D5)s%(D6)s
-      %(D7)s%(D8)s%(D9)s
-"""
-
-
-class Cube:
-    COLOR_LETTERS = ["W", "R", "G", "Y", "O", "B"]
-    COLOR_ASCII_CODES = ["48;5;15", "48;5;1", "48;5;2", "48;5;11", "48;5;9", "48;5;4"]
-    FACES = ["U", "R", "F", "D", "L", "B"]
-
-    NUM_FACELETS = 54
-    FACE_SIZE = 9
+from time import ticks_diff, ticks_ms
+
+
+class CubeTracker:
+    FACES = ("U", "R", "F", "D", "L", "B")
 
     ORIENTATIONS = {
         "up": 0,
@@ -51,323 +17,255 @@ class Cube:
         "back": 5,
     }
 
-    VALID_MOVES = {
-        move + variation
-        for move in FACES + ["y", "x", "z"]
-        for variation in ["", "'", "2"]
-    }
-
+    # Only whole-cube rotations are tracked on the Hub: the colors of the
+    # faces, and the face turns, are tracked on the Pi
     # fmt: off
-    TRANSFORMATIONS = {
-        "U":  [ 6,  3,  0,  7,  4,  1,  8,  5,  2,
-               45, 46, 47, 12, 13, 14, 15, 16, 17,
-                9, 10, 11, 21, 22, 23, 24, 25, 26,
-               27, 28, 29, 30, 31, 32, 33, 34, 35,
-               18, 19, 20, 39, 40, 41, 42, 43, 44,
-               36, 37, 38, 48, 49, 50, 51, 52, 53],
-        "U'": [ 2,  5,  8,  1,  4,  7,  0,  3,  6,
-               18, 19, 20, 12, 13, 14, 15, 16, 17,
-               36, 37, 38, 21, 22, 23, 24, 25, 26,
-               27, 28, 29, 30, 31, 32, 33, 34, 35,
-               45, 46, 47, 39, 40, 41, 42, 43, 44,
-                9, 10, 11, 48, 49, 50, 51, 52, 53],
-
-        "R":  [ 0,  1, 20,  3,  4, 23,  6,  7, 26,
-               15, 12,  9, 16, 13, 10, 17, 14, 11,
-               18, 19, 29, 21, 22, 32, 24, 25, 35,
-               27, 28, 51, 30, 31, 48, 33, 34, 45,
-               36, 37, 38, 39, 40, 41, 42, 43, 44,
-                8, 46, 47,  5, 49, 50,  2, 52, 53],
-        "R'": [ 0,  1, 51,  3,  4, 48,  6,  7, 45,
-               11, 14, 17, 10, 13, 16,  9, 12, 15,
-               18, 19,  2, 21, 22,  5, 24, 25,  8,
-               27, 28, 20, 30, 31, 23, 33, 34, 26,
-               36, 37, 38, 39, 40, 41, 42, 43, 44,
-               35, 46, 47, 32, 49, 50, 29, 52, 53],
-
-        "F":  [ 0,  1,  2,  3,  4,  5, 44, 41, 38,
-                6, 10, 11,  7, 13, 14,  8, 16, 17,
-               24, 21, 18, 25, 22, 19, 26, 23, 20,
-               15, 12,  9, 30, 31, 32, 33, 34, 35,
-               36, 37, 27, 39, 40, 28, 42, 43, 29,
-               45, 46, 47, 48, 49, 50, 51, 52, 53],
-        "F'": [ 0,  1,  2,  3,  4,  5,  9, 12, 15,
-               29, 10, 11, 28, 13, 14, 27, 16, 17,
-               20, 23, 26, 19, 22, 25, 18, 21, 24,
-               38, 41, 44, 30, 31, 32, 33, 34, 35,
-               36, 37,  8, 39, 40,  7, 42, 43,  6,
-               45, 46, 47, 48, 49, 50, 51, 52, 53],
-
-        "D":  [ 0,  1,  2,  3,  4,  5,  6,  7,  8,
-                9, 10, 11, 12, 13, 14, 24, 25, 26,
-               18, 19, 20, 21, 22, 23, 42, 43, 44,
-               33, 30, 27, 34, 31, 28, 35, 32, 29,
-               36, 37, 38, 39, 40, 41, 51, 52, 53,
-               45, 46, 47, 48, 49, 50, 15, 16, 17],
-        "D'": [ 0,  1,  2,  3,  4,  5,  6,  7,  8,
-                9, 10, 11, 12, 13, 14, 51, 52, 53,
-               18, 19, 20, 21, 22, 23, 15, 16, 17,
-               29, 32, 35, 28, 31, 34, 27, 30, 33,
-               36, 37, 38, 39, 40, 41, 24, 25, 26,
-               45, 46, 47, 48, 49, 50, 42, 43, 44],
-
-        "L":  [53,  1,  2, 50,  4,  5, 47,  7,  8,
-                9, 10, 11, 12, 13, 14, 15, 16, 17,
-                0, 19, 20,  3, 22, 23,  6, 25, 26,
-               18, 28, 29, 21, 31, 32, 24, 34, 35,
-               42, 39, 36, 43, 40, 37, 44, 41, 38,
-               45, 46, 33, 48, 49, 30, 51, 52, 27],
-        "L'": [18,  1,  2, 21,  4,  5, 24,  7,  8,
-                9, 10, 11, 12, 13, 14, 15, 16, 17,
-               27, 19, 20, 30, 22, 23, 33, 25, 26,
-               53, 28, 29, 50, 31, 32, 47, 34, 35,
-               38, 41, 44, 37, 40, 43, 36, 39, 42,
-               45, 46,  6, 48, 49,  3, 51, 52,  0],
-
-        "B":  [11, 14, 17,  3,  4,  5,  6,  7,  8,
-                9, 10, 35, 12, 13, 34, 15, 16, 33,
-               18, 19, 20, 21, 22, 23, 24, 25, 26,
-               27, 28, 29, 30, 31, 32, 36, 39, 42,
-                2, 37, 38,  1, 40, 41,  0, 43, 44,
-               51, 48, 45, 52, 49, 46, 53, 50, 47],
-        "B'": [42, 39, 36,  3,  4,  5,  6,  7,  8,
-                9, 10,  0, 12, 13,  1, 15, 16,  2,
-               18, 19, 20, 21, 22, 23, 24, 25, 26,
-               27, 28, 29, 30, 31, 32, 17, 14, 11,
-               33, 37, 38, 34, 40, 41, 35, 43, 44,
-               47, 50, 53, 46, 49, 52, 45, 48, 51],
-
-        "y":  [ 6,  3,  0,  7,  4,  1,  8,  5,  2,
-               45, 46, 47, 48, 49, 50, 51, 52, 53,
-                9, 10, 11, 12, 13, 14, 15, 16, 17,
-               29, 32, 35, 28, 31, 34, 27, 30, 33,
-               18, 19, 20, 21, 22, 23, 24, 25, 26,
-               36, 37, 38, 39, 40, 41, 42, 43, 44],
-        "y'": [ 2,  5,  8,  1,  4,  7,  0,  3,  6,
-               18, 19, 20, 21, 22, 23, 24, 25, 26,
-               36, 37, 38, 39, 40, 41, 42, 43, 44,
-               33, 30, 27, 34, 31, 28, 35, 32, 29,
-               45, 46, 47, 48, 49, 50, 51, 52, 53,
-                9, 10, 11, 12, 13, 14, 15, 16, 17],
-
-        "x":  [18, 19, 20, 21, 22, 23, 24, 25, 26,
-               15, 12,  9, 16, 13, 10, 17, 14, 11,
-               27, 28, 29, 30, 31, 32, 33, 34, 35,
-               53, 52, 51, 50, 49, 48, 47, 46, 45,
-               38, 41, 44, 37, 40, 43, 36, 39, 42,
-                8,  7,  6,  5,  4,  3,  2,  1,  0],
-        "x'": [53, 52, 51, 50, 49, 48, 47, 46, 45,
-               11, 14, 17, 10, 13, 16,  9, 12, 15,
-                0,  1,  2,  3,  4,  5,  6,  7,  8,
-               18, 19, 20, 21, 22, 23, 24, 25, 26,
-               42, 39, 36, 43, 40, 37, 44, 41, 38,
-               35, 34, 33, 32, 31, 30, 29, 28, 27],
-
-        "z":  [42, 39, 36, 43, 40, 37, 44, 41, 38,
-                6,  3,  0,  7,  4,  1,  8,  5,  2,
-               24, 21, 18, 25, 22, 19, 26, 23, 20,
-               15, 12,  9, 16, 13, 10, 17, 14, 11,
-               33, 30, 27, 34, 31, 28, 35, 32, 29,
-               47, 50, 53, 46, 49, 52, 45, 48, 51],
-        "z'": [11, 14, 17, 10, 13, 16,  9, 12, 15,
-               29, 32, 35, 28, 31, 34, 27, 30, 33,
-               20, 23, 26, 19, 22, 25, 18, 21, 24,
-               38, 41, 44, 37, 40, 43, 36, 39, 42,
-                2,  5,  8,  1,  4,  7,  0,  3,  6,
-               51, 48, 45, 52, 49, 46, 53, 50, 47],
-    }
-
     ORIENTATION_TRANSFORMATIONS = {
-        "y":  [0, 5, 1, 3, 2, 4],
-        "y'": [0, 2, 4, 3, 5, 1],
-        "x":  [2, 1, 3, 5, 4, 0],
-        "x'": [5, 1, 0, 2, 4, 3],
-        "z":  [4, 0, 2, 1, 3, 5],
-        "z'": [1, 3, 2, 4, 0, 5],
+        "y":  bytes((0, 5, 1, 3, 2, 4)),
+        "y'": bytes((0, 2, 4, 3, 5, 1)),
+        "x":  bytes((2, 1, 3, 5, 4, 0)),
+        "x'": bytes((5, 1, 0, 2, 4, 3)),
+        "z":  bytes((4, 0, 2, 1, 3, 5)),
+        "z'": bytes((1, 3, 2, 4, 0, 5)),
     }
     # fmt: on
 
-    def __init__(self, init_conf=None):
-        if init_conf:
-            self.cube = [
-                Cube.FACES.index(init_conf[i]) if i < len(init_conf) else None
-                for i in range(0, Cube.NUM_FACELETS)
-            ]
-            self.reset_orientation()
-        else:
-            self.cube = [
-                f for f in range(0, len(Cube.FACES)) for _ in range(0, Cube.FACE_SIZE)
-            ]
-            self.faces = list(Cube.FACES)
+    MOVES = {
+        "y": ("y", 1),
+        "y'": ("y'", 1),
+        "y2": ("y", 2),
+        "x": ("x", 1),
+        "x'": ("x'", 1),
+        "x2": ("x", 2),
+        "z": ("z", 1),
+        "z'": ("z'", 1),
+        "z2": ("z", 2),
+    }
+
+    def __init__(self):
+        self.faces = bytearray(len(CubeTracker.FACES))
+        self.faces_scratch = bytearray(len(CubeTracker.FACES))
+        for i in range(len(CubeTracker.FACES)):
+            self.faces[i] = i
 
     def _apply_one_transformation(self, transformation):
-        if transformation not in Cube.TRANSFORMATIONS:
-            raise ValueError("Invalid transformation '%s'" % transformation)
-        t = Cube.TRANSFORMATIONS[transformation]
-        new_conf = [self.cube[t[i]] for i in range(0, Cube.NUM_FACELETS)]
-        self.cube = new_conf
-        if transformation in Cube.ORIENTATION_TRANSFORMATIONS:
-            ot = Cube.ORIENTATION_TRANSFORMATIONS[transformation]
-            new_faces = [self.faces[ot[i]] for i in range(0, len(self.faces))]
-            self.faces = new_faces
-
-    def apply(self, moves):
-        for m in moves.strip().split():
-            if m not in Cube.VALID_MOVES:
-                raise ValueError("Invalid move '%s'" % m)
-        mvs = re.sub(r"([URFDLBxyz])2", r"\1 \1", moves).strip().split()
-        for move in mvs:
-            self._apply_one_transformation(move)
+        ot = CubeTracker.ORIENTATION_TRANSFORMATIONS[transformation]
+        faces, scratch = self.faces, self.faces_scratch
+        for i in range(len(CubeTracker.FACES)):
+            scratch[i] = faces[ot[i]]
+        self.faces, self.faces_scratch = scratch, faces
+
+    def apply(self, move):
+        if move not in CubeTracker.MOVES:
+            raise ValueError("Invalid move '%s'" % move)
+        transformation, times = CubeTracker.MOVES[move]
+        for _ in range(times):
+            self._apply_one_transformation(transformation)
 
     def get_oriented_face(self, direction):
-        if direction not in Cube.ORIENTATIONS:
+        if direction not in CubeTracker.ORIENTATIONS:
             raise ValueError("Invalid direction '%s'" % direction)
-        return self.faces[Cube.ORIENTATIONS[direction]]
-
-    def assign_colors_top_face(self, colors):
-        for i, c in enumerate(colors):
-            self.cube[i] = Cube.COLOR_LETTERS.index(c)
-
-    def reset_orientation(self):
-        self.faces = [Cube.FACES[self.cube[i]] for i in (4, 13, 22, 31, 40, 49)]
-
-    def bring_to_canonical(self):
-        if self.faces[1] == "U":
-            self.apply("z'")
-        elif self.faces[2] == "U":
-            self.apply("x")
-        elif self.faces[3] == "U":
-            self.apply("x2")
-        elif self.faces[4] == "U":
-            self.apply("z")
-        elif self.faces[5] == "U":
-            self.apply("x'")
-        if self.faces[1] == "F":
-            self.apply("y")
-        elif self.faces[4] == "F":
-            self.apply("y'")
-        elif self.faces[5] == "F":
-            self.apply("y2")
-
-    def get_cube_in_canonical_orientation(self):
-        nc = Cube(str(self))
-        nc.bring_to_canonical()
-        return str(nc)
-
-    def __str__(self):
-        return "".join([Cube.FACES[self.cube[i]] for i in range(0, Cube.NUM_FACELETS)])
-
-    def print(self, mode="colors"):
-        if mode == "colors":
-            print(
-                CUBE_PRINT_COLORS_TEMPLATE
-                % dict(
-                    [
-                        (
-                            "%s%d" % (f, i + 1),
-                            "\x1b[%sm  \x1b[0m"
-                            % Cube.COLOR_ASCII_CODES[
-                                self.cube[f_ind * Cube.FACE_SIZE + i]
-                            ],
-                        )
-                        for (f_ind, f) in enumerate(Cube.FACES)
-                        for i in range(0, Cube.FACE_SIZE)
-                    ]
-                )
-            )
-        else:
-            print(
-                CUBE_PRINT_LETTERS_TEMPLATE
-                % dict(
-                    [
-                        (
-                            "%s%d" % (f, i + 1),
-                            Cube.COLOR_LETTERS[self.cube[f_ind * Cube.FACE_SIZE + i]],
-                        )
-                        for (f_ind, f) in enumerate(Cube.FACES)
-                        for i in range(0, Cube.FACE_SIZE)
-                    ]
-                )
-            )
+        return CubeTracker.FACES[self.faces[CubeTracker.ORIENTATIONS[direction]]]
 
+    def get_orientation(self):
+        return "".join(CubeTracker.FACES[f] for f in self.faces)
 
-class Cubot:
-    TURN_RATIO = 3  #  24 / 8
-    VALID_MOVES = {
-        move + variation for move in Cube.FACES for variation in ["", "'", "2"]
-    }
-    OPPOSITES = {
-        Cube.FACES[i]: Cube.FACES[(i + 3) % 6] for i in range(0, len(Cube.FACES))
-    }
+    def set_orientation(self, faces):
+        for i in range(len(CubeTracker.FACES)):
+            self.faces[i] = CubeTracker.FACES.index(faces[i])
 
-    def __init__(self):
+
+class Cubot:
+    TURN_RATIO = 3  #  24 / 8
+    # Stop actions of the plan steps, as constants of the low-level motor API
+    STOP_ACTIONS = {"b": "STOP_BRAKE", "h": "STOP_HOLD", "c": "STOP_FLOAT"}
+    # Polling intervals (in ms) of the cooperating tasks
+    MOTOR_POLL = 10
+    SERIAL_POLL = 5
+    SENSOR_POLL = 50
+    STREAM_INTERVAL = 20
+    # A motor is settled once its speed (in %) and its distance to the target
+    # (in degrees) stay within tolerance for a few consecutive readings
+    SPEED_TOLERANCE = 1
+    POSITION_TOLERANCE = 3
+    SETTLE_READINGS = 3
+    SETTLE_INTERVAL = 10
+    SETTLE_TIMEOUT = 1000
+    START_TIMEOUT = 500
+    RESET_TIMEOUT = 3000
+    PI_READY_TIMEOUT = 30000
+    PI_STATUS_INTERVAL = 500
+
+    def __init__(self, scan_on_the_fly=False):
         self.hub = MSHub()
         self.vcp = hub.USB_VCP()
         self.grabbing_arm = Motor("E")
         self.turning_base = Motor("A")
+        # Moves are started through the low-level API, which does not block,
+        # and awaited by polling, so that the other tasks keep running
+        self.grabbing_arm_port = hub.port.E.motor
+        self.turning_base_port = hub.port.A.motor
+        self.scan_on_the_fly = scan_on_the_fly
         self.distance_sensor = DistanceSensor("C")
         self.grabbing_arm_home_pos = self.grabbing_arm.get_position()
         self.turning_base_home_pos = self.turning_base.get_position()
+        self.turning_base_home_count = self.turning_base.get_degrees_counted()
+        self.grabbing_arm_target = None
         self.last_turn_sense = None
+        # Count, total and maximum (in ms) of the waits, by label: updated in
+        # place, so that the heap does not grow with every solve
+        self.wait_times = {}
+        self.pi_capabilities = []
+        self.scanned_faces = []
+        self.responses = {}
+        self.response_received = uasyncio.Event()
 
         for motor in [self.grabbing_arm, self.turning_base]:
             motor.set_stop_action("brake")
             motor.set_stall_detection(True)
 
-        self.cube = Cube()
-
-    def reset_grabbing_arm(self):
+        self.cube = CubeTracker()
+
+    def _log_wait(self, label, start, settled):
+        elapsed = ticks_diff(ticks_ms(), start)
+        times = self.wait_times.get(label)
+        if times is None:
+            times = self.wait_times[label] = [0, 0, 0]
+        times[0] += 1
+        times[1] += elapsed
+        if elapsed > times[2]:
+            times[2] = elapsed
+        if settled:
+            print("Waited %d ms for %s" % (elapsed, label))
+        else:
+            print("Timed out after %d ms waiting for %s" % (elapsed, label))
+        return settled
+
+    async def _wait_for_motion(self, motor, label, timeout=START_TIMEOUT):
+        start = ticks_ms()
+        while ticks_diff(ticks_ms(), start) < timeout:
+            if abs(motor.get_speed()) > Cubot.SPEED_TOLERANCE:
+                return self._log_wait(label, start, True)
+            await uasyncio.sleep_ms(Cubot.SETTLE_INTERVAL)
+        return self._log_wait(label, start, False)
+
+    async def _wait_until_settled(
+        self, motor, label, target=None, timeout=SETTLE_TIMEOUT
+    ):
+        start = ticks_ms()
+        readings = 0
+        while ticks_diff(ticks_ms(), start) < timeout:
+            settled = abs(motor.get_speed()) <= Cubot.SPEED_TOLERANCE
+            if settled and target is not None:
+                error = (motor.get_position() - target + 180) % 360 - 180
+                settled = abs(error) <= Cubot.POSITION_TOLERANCE
+            readings = readings + 1 if settled else 0
+            if readings >= Cubot.SETTLE_READINGS:
+                return self._log_wait(label, start, True)
+            await uasyncio.sleep_ms(Cubot.SETTLE_INTERVAL)
+        return self._log_wait(label, start, False)
+
+    async def _wait_until_arm_settled(self, label):
+        await self._wait_until_settled(
+            self.grabbing_arm, label, self.grabbing_arm_target
+        )
+
+    async def _wait_until_base_settled(self, label):
+        await self._wait_until_settled(self.turning_base, label)
+
+    async def reset_grabbing_arm(self):
         self.grabbing_arm.start_at_power(40)
-        wait_for_seconds(1)
-        wait_until(self.grabbing_arm.get_speed, equal_to, 0)
+        # The arm is pushed against its end stop: it is home once it stalls
+        await self._wait_for_motion(self.grabbing_arm, "arm to start")
+        await self._wait_until_settled(
+            self.grabbing_arm, "arm to stall", timeout=Cubot.RESET_TIMEOUT
+        )
         self.grabbing_arm.stop()
         self.grabbing_arm_home_pos = self.grabbing_arm.get_position()
+        self.grabbing_arm_target = self.grabbing_arm_home_pos
 
     def reset_turning_base(self):
         self.turning_base_home_pos = self.turning_base.get_position()
+        self.turning_base_home_count = self.turning_base.get_degrees_counted()
 
-    def reset_all(self):
-        self.reset_grabbing_arm()
+    async def reset_all(self):
+        await self.reset_grabbing_arm()
         self.reset_turning_base()
-        wait_for_seconds(0.5)
+        await self._wait_until_arm_settled("arm at home")
+
+    @staticmethod
+    def _start_motor(port, degrees, speed, stop_action):
+        port.run_for_degrees(
+            degrees, speed, stop=getattr(port, Cubot.STOP_ACTIONS[stop_action])
+        )
 
-    def _move_grabbing_arm_to_pos(self, pos, speed=70):
+    @staticmethod
+    async def _wait_for_motor(port):
+        await uasyncio.sleep_ms(Cubot.MOTOR_POLL)
+        while port.busy(port.BUSY_MOTOR):
+            await uasyncio.sleep_ms(Cubot.MOTOR_POLL)
+
+    def _start_grabbing_arm_to_pos(self, pos, speed, stop_action):
         target_position = self.grabbing_arm_home_pos + pos
         if target_position < 0:
             target_position += 360
-        self.grabbing_arm.run_to_position(target_position, speed=speed)
-
-    def grab(self):
-        self.grabbing_arm.set_stop_action("hold")
-        self._move_grabbing_arm_to_pos(-75)
-
-    def tilt(self):
-        print("Tilting cube")
-        self.grab()
-        self._move_grabbing_arm_to_pos(-155)
-        wait_for_seconds(0.05)
-        self._move_grabbing_arm_to_pos(-55, 100)
-        self._move_grabbing_arm_to_pos(-75)
-        wait_for_seconds(0.05)
-        self.cube.apply("z")
-
-    def rest(self):
-        self._move_grabbing_arm_to_pos(0, 40)
-        self.grabbing_arm.set_stop_action("brake")
+        self.grabbing_arm_target = target_position
+        Cubot._start_motor(
+            self.grabbing_arm_port, pos - self._grabbing_arm_pos(), speed, stop_action
+        )
+
+    async def _move_grabbing_arm_to_pos(self, pos, speed=70, stop_action="h"):
+        self._start_grabbing_arm_to_pos(pos, speed, stop_action)
+        await Cubot._wait_for_motor(self.grabbing_arm_port)
+
+    async def _run_turning_base(self, degrees, speed, stop_action="h"):
+        Cubot._start_motor(self.turning_base_port, degrees, speed, stop_action)
+        await Cubot._wait_for_motor(self.turning_base_port)
+
+    async def rest(self):
+        await self._move_grabbing_arm_to_pos(0, 40, "b")
+
+    def _grabbing_arm_pos(self):
+        pos = self.grabbing_arm.get_position() - self.grabbing_arm_home_pos
+        return (pos + 180) % 360 - 180
+
+    def _turning_base_error(self):
+        # Distance of the cube from the nearest aligned position, in degrees
+        quarter = Cubot.TURN_RATIO * 90
+        count = self.turning_base.get_degrees_counted() - self.turning_base_home_count
+        return ((count + quarter // 2) % quarter - quarter // 2) // Cubot.TURN_RATIO
+
+    def _stream_positions(self):
+        self.vcp.write(
+            "POS %d %d\n" % (self._turning_base_error(), self._grabbing_arm_pos())
+        )
+
+    async def rest_streaming(self):
+        # Same as rest(), but the motor positions are streamed to the Pi
+        # while the arm moves, so that the face can be captured as soon as
+        # the arm is out of the way
+        self._start_grabbing_arm_to_pos(0, 40, "b")
+        # Same as in _wait_for_motor: the motor is not reported busy at once
+        await uasyncio.sleep_ms(Cubot.MOTOR_POLL)
+        while True:
+            self._stream_positions()
+            if not self.grabbing_arm_port.busy(self.grabbing_arm_port.BUSY_MOTOR):
+                break
+            await uasyncio.sleep_ms(Cubot.STREAM_INTERVAL)
+        self.vcp.write("END\n")
 
     @staticmethod
     def _check_direction(direction):
         assert direction in ["clockwise", "counterclockwise"]
 
-    def rotate_cube(self, sense, times=1):
+    async def rotate_cube(self, sense, times=1):
         print("Rotating cube %d degrees %s" % (90 * times, sense))
         Cubot._check_direction(sense)
-        self.rest()
-        self.turning_base.set_stop_action("hold")
+        await self.rest()
         distance_in_degrees = Cubot.TURN_RATIO * 90 * times
         if sense == "clockwise":
             distance_in_degrees = -distance_in_degrees
-        self.turning_base.run_for_degrees(distance_in_degrees, 80)
+        await self._run_turning_base(distance_in_degrees, 80)
         if times % 4 == 1:
             if sense == "clockwise":
                 self.cube.apply("y")
@@ -381,73 +279,46 @@ class Cubot:
         elif times % 4 == 2:
             self.cube.apply("y2")
 
-    def turn_bottom_face(self, sense, times=1):
-        print("Turning face %d degrees %s" % (90 * times, sense))
-        Cubot._check_direction(sense)
-        self.grab()
-        self.turning_base.set_stop_action("hold")
-        distance_in_degrees = Cubot.TURN_RATIO * 90 * times
-        extra_distance = Cubot.TURN_RATIO * 22
-        if self.last_turn_sense and self.last_turn_sense == sense:
-            extra_distance += Cubot.TURN_RATIO * 3
-        if sense == "counterclockwise":
-            distance_in_degrees = -distance_in_degrees
-            extra_distance = -extra_distance
-        self.turning_base.run_for_degrees(distance_in_degrees + extra_distance, 80)
-        self.turning_base.run_for_degrees(-extra_distance, 80)
-        self.last_turn_sense = sense
-        if sense == "clockwise":
-            self.cube.apply("D" if times == 1 else "D2")
-        else:
-            self.cube.apply("D'" if times == 1 else "D2")
+    def _cube_closer_than(self, distance):
+        d = self.distance_sensor.get_distance_cm(short_range=True)
+        return d is not None and d < distance
 
-    def wait_for_cube(self):
+    async def wait_for_cube(self):
         self.distance_sensor.light_up_all()
         self.hub.light_matrix.show_image("SQUARE")
-        self.distance_sensor.wait_for_distance_closer_than(5, "cm", True)
+        while not self._cube_closer_than(5):
+            await uasyncio.sleep_ms(Cubot.SENSOR_POLL)
         self.hub.light_matrix.show_image("SQUARE_SMALL")
-        wait_for_seconds(0.5)
+        await uasyncio.sleep_ms(500)
         self.distance_sensor.light_up_all(0)
 
-    def wait_for_cube_removal(self):
+    async def wait_for_cube_removal(self):
         self.distance_sensor.light_up_all()
         self.hub.light_matrix.show_image("SQUARE_SMALL")
-        self.distance_sensor.wait_for_distance_farther_than(10, "cm", True)
+        while self._cube_closer_than(10):
+            await uasyncio.sleep_ms(Cubot.SENSOR_POLL)
         self.hub.light_matrix.show_image("SQUARE")
-        wait_for_seconds(0.5)
+        await uasyncio.sleep_ms(500)
         self.distance_sensor.light_up_all(0)
 
-    @staticmethod
-    def _parse_move(move):
-        sense = "counterclockwise" if move.endswith("'") else "clockwise"
-        times = 2 if move.endswith("2") else 1
-        return move[0], sense, times
-
-    def _place_face_down(self, face):
-        if self.cube.get_oriented_face("front") == face:
-            self.rotate_cube("counterclockwise")
-        elif self.cube.get_oriented_face("back") == face:
-            self.rotate_cube("clockwise")
-        elif self.cube.get_oriented_face("left") == face:
-            self.rotate_cube("clockwise", 2)
-        elif self.cube.get_oriented_face("up") == face:
-            self.tilt()
-        if self.cube.get_oriented_face("right") == face:
-            self.tilt()
-
-    def _apply_one_move(self, move):
-        print("Applying move:", move)
-        face, sense, times = self._parse_move(move)
-        self._place_face_down(face)
-        self.turn_bottom_face(sense, times)
-
-    def apply_moves(self, moves):
-        mvs = moves.strip().split()
-        for move in mvs:
-            if move not in Cubot.VALID_MOVES:
-                raise ValueError("Invalid move '%s'" % move)
-        for move in mvs:
-            self._apply_one_move(move)
+    async def execute_plan(self, plan):
+        for step in plan.split():
+            kind = step[0]
+            if kind == "W":
+                await uasyncio.sleep_ms(int(step[1:]))
+                continue
+            if kind == "S":
+                await self._wait_until_arm_settled("arm to settle")
+                continue
+            value, speed, stop_action = step[1:].split(":")
+            if kind == "E":
+                await self._move_grabbing_arm_to_pos(
+                    int(value), int(speed), stop_action
+                )
+            elif kind == "A":
+                await self._run_turning_base(int(value), int(speed), stop_action)
+            else:
+                raise ValueError("Invalid plan step '%s'" % step)
 
     def _check_connection(self):
         if not self.vcp.isconnected():
@@ -456,8 +327,11 @@ class Cubot:
     def write(self, msg):
         self.hub.light_matrix.write(msg)
 
-    def ok_beep(self):
-        self.hub.speaker.beep(80, 0.2)
+    async def ok_beep(self):
+        # beep() blocks every task for its whole duration
+        self.hub.speaker.start_beep(80)
+        await uasyncio.sleep_ms(200)
+        self.hub.speaker.stop()
 
     def error_beep(self):
         self.hub.speaker.beep(60, 1.5)
@@ -477,58 +351,127 @@ class Cubot:
         self.hub.light_matrix.show_image("ARROW_N")
         self._check_connection()
         self.vcp.write(command + "\n")
-        self.ok_beep()
+        uasyncio.create_task(self.ok_beep())
 
-    def wait_for_response(self):
-        self.hub.light_matrix.show_image("ARROW_S")
-        response = ""
+    async def read_serial(self):
+        # Runs for the whole session. The responses of the Pi are sorted by
+        # status, since the ones of different commands interleave: a capture
+        # is acknowledged before the colors of the previous face are awaited
+        buffer = ""
         while True:
             if self.vcp.any():
                 input_data = self.vcp.read()
                 if input_data:
-                    response += input_data.decode("utf-8").strip()
-                    status, *data = response.split()
-                    if status == "OK":
-                        self.hub.light_matrix.show_image("SQUARE_SMALL")
-                        return " ".join(data)
-                    else:
-                        raise Exception("ERROR!")
-
-    def run(self):
+                    buffer += input_data.decode("utf-8")
+                    while "\n" in buffer:
+                        line, buffer = buffer.split("\n", 1)
+                        if line.strip():
+                            status, *data = line.split()
+                            self.responses.setdefault(status, []).append(
+                                " ".join(data)
+                            )
+                            self.response_received.set()
+            await uasyncio.sleep_ms(Cubot.SERIAL_POLL)
+
+    async def wait_for_response(self, status="OK"):
+        self.hub.light_matrix.show_image("ARROW_S")
+        while not self.responses.get(status):
+            for other in self.responses:
+                if other not in ("OK", "CAPTURED") and self.responses[other]:
+                    raise Exception("ERROR!")
+            self.response_received.clear()
+            await self.response_received.wait()
+        self.hub.light_matrix.show_image("SQUARE_SMALL")
+        return self.responses[status].pop(0)
+
+    async def wait_for_pi(self, timeout=PI_READY_TIMEOUT):
+        # The Pi queues the commands it receives while warming up, but the
+        # capabilities it reports decide how the cube is scanned
+        start = ticks_ms()
+        while True:
+            self._check_connection()
+            self.vcp.write("STATUS\n")
+            status, capabilities = (await self.wait_for_response()).split()
+            self.pi_capabilities = capabilities.split(",")
+            if status == "READY" or ticks_diff(ticks_ms(), start) > timeout:
+                break
+            await uasyncio.sleep_ms(Cubot.PI_STATUS_INTERVAL)
+        print("PiCube %s (%s)" % (status, capabilities))
+
+    async def scan(self):
+        # The Pi plans the moves and captures of the scan (C<face>:<faces>
+        # steps, with the orientation of the cube at the capture). It
+        # acknowledges each capture before reading its colors, so the next
+        # face is moved into place meanwhile. After the last capture, the task
+        # moving the arm back is returned still running
+        self.send_command("SCANPLAN %s" % self.cube.get_orientation())
+        plan = (await self.wait_for_response()).split()
+        self.scanned_faces = []
+        arm = None
+        for step in plan:
+            if arm:
+                await arm
+                arm = None
+            if step[0] != "C":
+                await self.execute_plan(step)
+                continue
+            face, faces = step[1:].split(":")
+            self.scanned_faces.append(face)
+            self.cube.set_orientation(faces)
+            if self.scan_on_the_fly and "SCAN" in self.pi_capabilities:
+                self.send_command("SCAN %s %s" % (face, self.cube.get_orientation()))
+                arm = uasyncio.create_task(self.rest_streaming())
+            else:
+                await self.rest()
+                await self._wait_until_arm_settled("arm to rest")
+                await self._wait_until_base_settled("base to stop")
+                self.send_command("DETECT %s %s" % (face, self.cube.get_orientation()))
+            await self.wait_for_response("CAPTURED")
+        return arm
+
+    async def run(self):
         while True:
-            self.wait_for_cube()
-            for face in ["L", "F", "D", "R", "B", "U"]:
-                try:
-                    self._place_face_down(Cubot.OPPOSITES[face])
-                    self.rest()
-                    wait_for_seconds(0.2)
-                    self.send_command("DETECT %s" % face)
-                    response = self.wait_for_response()
-                    self.cube.assign_colors_top_face(response)
-                except Exception as e:
-                    self.error_beep()
-                    self.write(str(e))
-                    return
-            wait_for_seconds(0.2)
-            self.cube.reset_orientation()
-            self.send_command(
-                "SOLVE %s" % self.cube.get_cube_in_canonical_orientation()
-            )
-            response = self.wait_for_response()
-            self.apply_moves(response)
-            self.rest()
-            self.rotate_cube("clockwise", 4)
+            await self.wait_for_cube()
+            try:
+                arm = await self.scan()
+                # The Pi has tracked the state and the orientation of the cube
+                # through the scan, and solves it as soon as the last colors
+                # are read. The colors received here are sent back with the
+                # plan request, for the Pi to check them against its own
+                captures = []
+                for face in self.scanned_faces:
+                    captures.append(face + await self.wait_for_response())
+                self.send_command(
+                    "PLAN @%s - %s" % (",".join(captures), self.last_turn_sense or "-")
+                )
+                if arm:
+                    await arm
+            except Exception as e:
+                self.error_beep()
+                self.write(str(e))
+                return
+            faces, last_turn_sense, *plan = (await self.wait_for_response()).split()
+            await self.execute_plan(" ".join(plan))
+            self.cube.set_orientation(faces)
+            self.last_turn_sense = None if last_turn_sense == "-" else last_turn_sense
+            await self.rest()
+            await self.rotate_cube("clockwise", 4)
             self.hub.light_matrix.show_image("SMILE")
             self.success_beep()
-            self.wait_for_cube_removal()
-
-
-c = Cubot()
-c.reset_all()
-try:
-    c.run()
-    c.end_beep()
-    c.write("Done!")
-except Exception as e:
-    c.error_beep()
-    c.write(str(e))
\ No newline at end of file
+            await self.wait_for_cube_removal()
+
+
+async def main(c):
+    uasyncio.create_task(c.read_serial())
+    await c.reset_all()
+    try:
+        await c.wait_for_pi()
+        await c.run()
+        c.end_beep()
+        c.write("Done!")
+    except Exception as e:
+        c.error_beep()
+        c.write(str(e))
+
+
+uasyncio.run(main(Cubot()))
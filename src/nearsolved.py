@@ -0,0 +1,167 @@
+import numpy as np
+import os
+
+from cubie import Cubies
+from os import path
+
+
+class NearSolvedIndex:
+    INDEX_FOLDER = "tables"
+    INDEX_NAME = "nearsolved"
+    DEFAULT_DEPTH = 6
+    MAX_STEPS = 20
+    SOLVED = 255
+    SEED = 20210314
+    CHUNK_SIZE = 200000
+
+    NUM_CUBIES = Cubies.NUM_CORNERS + Cubies.NUM_EDGES
+    SOLVED_STATE = [c * 3 for c in range(0, Cubies.NUM_CORNERS)] + [
+        e * 2 for e in range(0, Cubies.NUM_EDGES)
+    ]
+    # Zobrist hashing of the cubie slots: a 64-bit key with a random word per
+    # cubie and slot, fixed by the seed so that indexes can be rebuilt
+    ZOBRIST = np.random.default_rng(SEED).integers(
+        0, 2**64, size=(NUM_CUBIES, Cubies.NUM_SLOTS), dtype=np.uint64
+    )
+    ZOBRIST_KEYS = [[int(k) for k in row] for row in ZOBRIST]
+    MOVE_TABLES = np.array(
+        [
+            list(corner_moves) + list(edge_moves)
+            for (corner_moves, edge_moves) in zip(
+                Cubies.CORNER_MOVES, Cubies.EDGE_MOVES
+            )
+        ],
+        dtype=np.uint8,
+    ).reshape((len(Cubies.MOVES), 2, Cubies.NUM_SLOTS))
+
+    def __init__(self, keys, moves):
+        self.keys = keys
+        self.moves = moves
+
+    @staticmethod
+    def _files(folder):
+        base = path.join(folder, NearSolvedIndex.INDEX_NAME)
+        return base + "-keys.npy", base + "-moves.npy"
+
+    @staticmethod
+    def _hash(states):
+        cubies = np.arange(0, NearSolvedIndex.NUM_CUBIES)
+        return np.bitwise_xor.reduce(
+            NearSolvedIndex.ZOBRIST[cubies, states], axis=1
+        )
+
+    @staticmethod
+    def _key(slots):
+        key = 0
+        for (cubie, slot) in enumerate(slots):
+            key ^= NearSolvedIndex.ZOBRIST_KEYS[cubie][slot]
+        return key
+
+    @staticmethod
+    def _expand(states, last_faces):
+        children = []
+        moves = []
+        for m in range(0, len(Cubies.MOVES)):
+            # Turning the same face again is never shorter
+            parents = last_faces != m // 3
+            table = NearSolvedIndex.MOVE_TABLES[m]
+            moved = np.empty(
+                (int(parents.sum()), NearSolvedIndex.NUM_CUBIES), dtype=np.uint8
+            )
+            moved[:, : Cubies.NUM_CORNERS] = table[0][
+                states[parents, : Cubies.NUM_CORNERS]
+            ]
+            moved[:, Cubies.NUM_CORNERS :] = table[1][
+                states[parents, Cubies.NUM_CORNERS :]
+            ]
+            children.append(moved)
+            moves.append(np.full(len(moved), m, dtype=np.uint8))
+        return np.concatenate(children), np.concatenate(moves)
+
+    @staticmethod
+    def build(depth=DEFAULT_DEPTH, folder=INDEX_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+        frontier = np.array([NearSolvedIndex.SOLVED_STATE], dtype=np.uint8)
+        frontier_moves = np.array([NearSolvedIndex.SOLVED], dtype=np.uint8)
+        visited = NearSolvedIndex._hash(frontier)
+        all_keys = [visited]
+        all_moves = [frontier_moves]
+        for d in range(1, depth + 1):
+            layer_keys = []
+            layer_moves = []
+            layer_states = []
+            for start in range(0, len(frontier), NearSolvedIndex.CHUNK_SIZE):
+                chunk = slice(start, start + NearSolvedIndex.CHUNK_SIZE)
+                last_faces = np.where(
+                    frontier_moves[chunk] == NearSolvedIndex.SOLVED,
+                    len(Cubies.MOVES),
+                    frontier_moves[chunk] // 3,
+                )
+                states, moves = NearSolvedIndex._expand(frontier[chunk], last_faces)
+                keys, first = np.unique(
+                    NearSolvedIndex._hash(states), return_index=True
+                )
+                pos = np.minimum(np.searchsorted(visited, keys), len(visited) - 1)
+                new = visited[pos] != keys
+                layer_keys.append(keys[new])
+                layer_moves.append(moves[first[new]])
+                if d < depth:
+                    layer_states.append(states[first[new]])
+            keys, first = np.unique(np.concatenate(layer_keys), return_index=True)
+            moves = np.concatenate(layer_moves)[first]
+            print("🏗️ Depth %d: %d states" % (d, len(keys)))
+            all_keys.append(keys)
+            all_moves.append(moves)
+            visited = np.union1d(visited, keys)
+            if d < depth:
+                frontier = np.concatenate(layer_states)[first]
+                frontier_moves = moves
+
+        keys = np.concatenate(all_keys)
+        order = np.argsort(keys, kind="stable")
+        moves = np.concatenate(all_moves)[order]
+        # Store the move that brings each state one step closer to solved
+        to_solved = np.where(
+            moves == NearSolvedIndex.SOLVED,
+            NearSolvedIndex.SOLVED,
+            (moves // 3) * 3 + 2 - moves % 3,
+        ).astype(np.uint8)
+        keys_file, moves_file = NearSolvedIndex._files(folder)
+        np.save(keys_file, keys[order])
+        np.save(moves_file, to_solved)
+        return NearSolvedIndex(keys[order], to_solved)
+
+    @staticmethod
+    def load(folder=INDEX_FOLDER):
+        keys_file, moves_file = NearSolvedIndex._files(folder)
+        if not path.exists(keys_file) or not path.exists(moves_file):
+            return None
+        keys = np.load(keys_file, mmap_mode="r")
+        moves = np.load(moves_file, mmap_mode="r")
+        return NearSolvedIndex(keys, moves)
+
+    def _find(self, key):
+        i = int(np.searchsorted(self.keys, np.uint64(key)))
+        if i < len(self.keys) and int(self.keys[i]) == key:
+            return int(self.moves[i])
+        return None
+
+    def lookup(self, conf):
+        corners, edges = Cubies.from_facelets(conf)
+        slots = corners + edges
+        solution = []
+        # A hash collision can send the walk astray: it is bounded, and the
+        # final state is checked before answering
+        for _ in range(0, NearSolvedIndex.MAX_STEPS + 1):
+            move = self._find(NearSolvedIndex._key(slots))
+            if move is None:
+                return None
+            if move == NearSolvedIndex.SOLVED:
+                break
+            solution.append(Cubies.MOVES[move])
+            slots = [
+                Cubies.CORNER_MOVES[move][s] for s in slots[: Cubies.NUM_CORNERS]
+            ] + [Cubies.EDGE_MOVES[move][s] for s in slots[Cubies.NUM_CORNERS :]]
+        if slots != NearSolvedIndex.SOLVED_STATE:
+            return None
+        return " ".join(solution)
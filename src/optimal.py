@@ -0,0 +1,314 @@
+import multiprocessing
+import os
+import time
+
+from cubie import Cubies
+from os import path
+
+_TABLES = None
+_TIMEOUT = "timeout"
+
+
+class _Timeout(Exception):
+    pass
+
+
+class OptimalSolver:
+    TABLES_FOLDER = "tables"
+    # Pattern databases over groups of four cubies (position and orientation),
+    # indexed by the cubies' slots in base 24
+    CUBIE_GROUPS = [
+        ("corners-0123", "corners", (0, 1, 2, 3)),
+        ("corners-4567", "corners", (4, 5, 6, 7)),
+        ("edges-0123", "edges", (0, 1, 2, 3)),
+        ("edges-4567", "edges", (4, 5, 6, 7)),
+        ("edges-89AB", "edges", (8, 9, 10, 11)),
+    ]
+    GROUP_SIZE = Cubies.NUM_SLOTS**4
+    # ...plus one over the orientation of all corners and edges
+    NUM_CORNER_ORIENTATIONS = 3 ** (Cubies.NUM_CORNERS - 1)
+    NUM_EDGE_ORIENTATIONS = 2 ** (Cubies.NUM_EDGES - 1)
+    ORIENTATION_TABLE = "orientations"
+    MAX_DEPTH = 20
+    UNVISITED = 255
+    DEADLINE_CHECK_INTERVAL = 4096
+
+    # Weight of each corner (edge) slot in the orientation coordinate: the
+    # orientation of the last position is implied by the others
+    CORNER_ORIENTATION_WEIGHTS = [
+        (slot % 3) * 3 ** (slot // 3) if slot // 3 < Cubies.NUM_CORNERS - 1 else 0
+        for slot in range(0, Cubies.NUM_SLOTS)
+    ]
+    EDGE_ORIENTATION_WEIGHTS = [
+        (slot % 2) * 2 ** (slot // 2) if slot // 2 < Cubies.NUM_EDGES - 1 else 0
+        for slot in range(0, Cubies.NUM_SLOTS)
+    ]
+
+    def __init__(self, time_limit=60, processes=None, folder=TABLES_FOLDER):
+        self.time_limit = time_limit
+        self.processes = processes or os.cpu_count()
+        self.folder = folder
+
+    @staticmethod
+    def _table_file(folder, name):
+        return path.join(folder, "%s.pdb" % name)
+
+    @staticmethod
+    def _group_index(slots, cubies):
+        s = Cubies.NUM_SLOTS
+        return (
+            slots[cubies[0]]
+            + s * slots[cubies[1]]
+            + s * s * slots[cubies[2]]
+            + s * s * s * slots[cubies[3]]
+        )
+
+    @staticmethod
+    def _bfs(size, start, neighbours):
+        table = bytearray([OptimalSolver.UNVISITED]) * size
+        table[start] = 0
+        frontier = [start]
+        depth = 0
+        while frontier:
+            depth += 1
+            next_frontier = []
+            for index in frontier:
+                for n in neighbours(index):
+                    if table[n] == OptimalSolver.UNVISITED:
+                        table[n] = depth
+                        next_frontier.append(n)
+            frontier = next_frontier
+        return table
+
+    @staticmethod
+    def _build_group_table(kind, cubies):
+        if kind == "corners":
+            move_tables = Cubies.CORNER_MOVES
+        else:
+            move_tables = Cubies.EDGE_MOVES
+        step = 3 if kind == "corners" else 2
+        s = Cubies.NUM_SLOTS
+
+        def neighbours(index):
+            s0, s1, s2, s3 = (
+                index % s,
+                index // s % s,
+                index // (s * s) % s,
+                index // (s * s * s),
+            )
+            for t in move_tables:
+                yield t[s0] + s * t[s1] + s * s * t[s2] + s * s * s * t[s3]
+
+        num_cubies = Cubies.NUM_CORNERS if kind == "corners" else Cubies.NUM_EDGES
+        solved = [c * step for c in range(0, num_cubies)]
+        start = OptimalSolver._group_index(solved, cubies)
+        return OptimalSolver._bfs(OptimalSolver.GROUP_SIZE, start, neighbours)
+
+    @staticmethod
+    def _orientation_move_table(move_tables, num_positions, num_orientations):
+        # Moves a single orientation coordinate: per-position orientations
+        # encoded in base num_orientations, the last position being implied
+        size = num_orientations ** (num_positions - 1)
+        table = []
+        for t in move_tables:
+            moved = []
+            for index in range(0, size):
+                oris = []
+                rest = index
+                for _ in range(0, num_positions - 1):
+                    rest, ori = divmod(rest, num_orientations)
+                    oris.append(ori)
+                oris.append(-sum(oris) % num_orientations)
+                new_index = 0
+                for pos, ori in enumerate(oris):
+                    new_pos, new_ori = divmod(
+                        t[pos * num_orientations + ori], num_orientations
+                    )
+                    if new_pos < num_positions - 1:
+                        new_index += new_ori * num_orientations**new_pos
+                moved.append(new_index)
+            table.append(moved)
+        return table
+
+    @staticmethod
+    def _build_orientation_table():
+        corner_moves = OptimalSolver._orientation_move_table(
+            Cubies.CORNER_MOVES, Cubies.NUM_CORNERS, 3
+        )
+        edge_moves = OptimalSolver._orientation_move_table(
+            Cubies.EDGE_MOVES, Cubies.NUM_EDGES, 2
+        )
+        moves = list(zip(corner_moves, edge_moves))
+        num_edge = OptimalSolver.NUM_EDGE_ORIENTATIONS
+
+        def neighbours(index):
+            co, eo = divmod(index, num_edge)
+            for (ct, et) in moves:
+                yield ct[co] * num_edge + et[eo]
+
+        return OptimalSolver._bfs(
+            OptimalSolver.NUM_CORNER_ORIENTATIONS * num_edge, 0, neighbours
+        )
+
+    @staticmethod
+    def build_tables(folder=TABLES_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+        tables = list(OptimalSolver.CUBIE_GROUPS)
+        tables.append((OptimalSolver.ORIENTATION_TABLE, None, None))
+        for name, kind, cubies in tables:
+            table_file = OptimalSolver._table_file(folder, name)
+            if path.exists(table_file):
+                continue
+            print("🏗️ Building pattern database %s..." % name)
+            if kind:
+                table = OptimalSolver._build_group_table(kind, cubies)
+            else:
+                table = OptimalSolver._build_orientation_table()
+            with open(table_file + ".tmp", "wb") as f:
+                f.write(table)
+            os.replace(table_file + ".tmp", table_file)
+
+    @staticmethod
+    def load_tables(folder=TABLES_FOLDER):
+        OptimalSolver.build_tables(folder)
+        names = [name for (name, _, _) in OptimalSolver.CUBIE_GROUPS]
+        names.append(OptimalSolver.ORIENTATION_TABLE)
+        tables = []
+        for name in names:
+            with open(OptimalSolver._table_file(folder, name), "rb") as f:
+                tables.append(f.read())
+        return tables
+
+    @staticmethod
+    def has_tables(folder=TABLES_FOLDER):
+        names = [name for (name, _, _) in OptimalSolver.CUBIE_GROUPS]
+        names.append(OptimalSolver.ORIENTATION_TABLE)
+        return all(
+            path.exists(OptimalSolver._table_file(folder, name)) for name in names
+        )
+
+    def load(self):
+        global _TABLES
+        if _TABLES is None:
+            _TABLES = OptimalSolver.load_tables(self.folder)
+
+    @staticmethod
+    def heuristic(tables, corners, edges):
+        h = 0
+        for (table, (_, kind, cubies)) in zip(tables, OptimalSolver.CUBIE_GROUPS):
+            slots = corners if kind == "corners" else edges
+            d = table[OptimalSolver._group_index(slots, cubies)]
+            if d > h:
+                h = d
+        cw = OptimalSolver.CORNER_ORIENTATION_WEIGHTS
+        ew = OptimalSolver.EDGE_ORIENTATION_WEIGHTS
+        d = tables[-1][
+            sum(cw[s] for s in corners) * OptimalSolver.NUM_EDGE_ORIENTATIONS
+            + sum(ew[s] for s in edges)
+        ]
+        return d if d > h else h
+
+    def solve(self, conf, best_known=None):
+        corners, edges = Cubies.from_facelets(conf)
+        limit = (
+            len(best_known.split()) if best_known else OptimalSolver.MAX_DEPTH + 1
+        )
+        deadline = time.time() + self.time_limit
+
+        # Building the tables takes minutes: it is only done ahead of time,
+        # by build-tables or by the warm-up of an optimal PiCube
+        if _TABLES is None and not OptimalSolver.has_tables(self.folder):
+            print(
+                "❗No pattern databases in %s, keeping %s" % (self.folder, best_known)
+            )
+            return best_known
+        self.load()
+        bound = OptimalSolver.heuristic(_TABLES, corners, edges)
+        if bound == 0:
+            return ""
+
+        # The workers are not forked from the Pi process, which runs the
+        # camera and several threads: they load the tables on their own
+        context = multiprocessing.get_context("forkserver")
+        # Each bound of the iterative deepening is split among the workers by
+        # first move; a bound reaching the best known length proves it optimal
+        with context.Pool(
+            self.processes, initializer=_init_worker, initargs=(self.folder,)
+        ) as pool:
+            while bound < limit:
+                tasks = [
+                    (corners, edges, m, bound, deadline)
+                    for m in range(0, len(Cubies.MOVES))
+                ]
+                timed_out = False
+                for result in pool.imap_unordered(_search_first_move, tasks):
+                    if result == _TIMEOUT:
+                        timed_out = True
+                    elif result is not None:
+                        return " ".join(Cubies.MOVES[m] for m in result)
+                if timed_out:
+                    print("⌛ Optimal search timed out at depth %d" % bound)
+                    break
+                bound += 1
+        return best_known
+
+
+def _init_worker(folder):
+    global _TABLES
+    if _TABLES is None:
+        _TABLES = OptimalSolver.load_tables(folder)
+
+
+def _search_first_move(task):
+    corners, edges, first_move, bound, deadline = task
+    corners = [Cubies.CORNER_MOVES[first_move][s] for s in corners]
+    edges = [Cubies.EDGE_MOVES[first_move][s] for s in edges]
+    path = [first_move]
+    search = _Search(_TABLES, deadline)
+    try:
+        if search.dfs(corners, edges, 1, bound, first_move // 3, path):
+            return path
+    except _Timeout:
+        return _TIMEOUT
+    return None
+
+
+class _Search:
+    SOLVED_CORNERS = [c * 3 for c in range(0, Cubies.NUM_CORNERS)]
+    SOLVED_EDGES = [e * 2 for e in range(0, Cubies.NUM_EDGES)]
+
+    def __init__(self, tables, deadline):
+        self.tables = tables
+        self.deadline = deadline
+        self.nodes = 0
+
+    def dfs(self, corners, edges, depth, bound, last_face, path):
+        self.nodes += 1
+        if self.nodes % OptimalSolver.DEADLINE_CHECK_INTERVAL == 0:
+            if time.time() > self.deadline:
+                raise _Timeout()
+        h = OptimalSolver.heuristic(self.tables, corners, edges)
+        if h == 0:
+            return corners == _Search.SOLVED_CORNERS and edges == _Search.SOLVED_EDGES
+        if depth + h > bound:
+            return False
+        for m in range(0, len(Cubies.MOVES)):
+            face = m // 3
+            # Never turn the same face twice in a row, and turn opposite faces
+            # in a single order
+            if face == last_face or (face + 3) % 6 == last_face and face < last_face:
+                continue
+            cm = Cubies.CORNER_MOVES[m]
+            em = Cubies.EDGE_MOVES[m]
+            path.append(m)
+            if self.dfs(
+                [cm[s] for s in corners],
+                [em[s] for s in edges],
+                depth + 1,
+                bound,
+                face,
+                path,
+            ):
+                return True
+            path.pop()
+        return False
@@ -1,12 +1,37 @@
-import cv2
-import numpy as np
-import picamera
+import json
 import serial
+import sys
+import threading
 import time
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from cube import Cube
+from optimal import OptimalSolver
 from os import path
-from twophase import solve
+from planner import MotorPlanner
+from scan import ScanTracker
+from scanplan import ScanPlanner
+
+# OpenCV, numpy and the two-phase solver take seconds to import and load on
+# the Pi: they are imported by the background warm-up of PiCube (or when a
+# camera is opened), so that the serial loop is up right away
+cv2 = None
+np = None
+solve = None
+
+
+def import_vision():
+    global cv2, np
+    if cv2 is None:
+        import cv2
+        import numpy as np
+
+
+def import_solver():
+    global solve
+    if solve is None:
+        from twophase import solve
 
 
 class CubotCam:
@@ -24,32 +49,324 @@ class CubotCam:
         ((250, 50), "C"),
     ]
     SAMPLING_RADIUS = 10
+    SQUARE_SIZE = 300
+    PERSPECTIVE_POINTS = [[140, 180], [465, 180], [-30, 465], [620, 465]]
+    CALIBRATION_FILE = "calibration.json"
+    SETTLE_TIMEOUT = 2
+    ISOS = (100, 200, 320, 400, 500, 640, 800)
+    # The gains have converged once they change by less than the tolerance
+    # over a few consecutive readings, about one frame apart
+    GAIN_TOLERANCE = 0.05
+    GAIN_READINGS = 3
+    GAIN_INTERVAL = 0.04
+    FEED_SIZE = 4
+    FEED_TIMEOUT = 1
+    # Mean absolute difference (on a subsampled green channel) under which
+    # two consecutive video frames are considered free of motion blur
+    MOTION_THRESHOLD = 4
+    MOTION_STEP = 8
+    # Resolution of the frames compared while waiting for the cube to stop
+    # moving: multiples of 32x16, so that the YUV planes are not padded
+    STEADY_SIZE = (160, 128)
+    STEADY_TIMEOUT = 0.5
 
     @staticmethod
-    def _init_pi_cam():
+    def _init_pi_cam(calibration=None):
+        # Only available on the Pi: imported here so that the rest of the
+        # module can be used offline (e.g. to replay a recorded session)
+        import picamera
+
         camera = picamera.PiCamera()
         camera.resolution = (CubotCam.IMG_WIDTH, CubotCam.IMG_HEIGHT)
         camera.framerate = 24
 
-        time.sleep(2)
+        if calibration:
+            gains = CubotCam._lock_exposure(camera, calibration)
+            expected = (calibration["analog_gain"], calibration["digital_gain"])
+            if any(
+                abs(g - e) > CubotCam.GAIN_TOLERANCE for (g, e) in zip(gains, expected)
+            ):
+                print(
+                    "❗Gains %.2f/%.2f, calibrated at %.2f/%.2f" % (gains + expected)
+                )
+        else:
+            time.sleep(CubotCam.SETTLE_TIMEOUT)
         return camera
 
-    def __init__(self):
-        self.cam = CubotCam._init_pi_cam()
+    @staticmethod
+    def _wait_for_gains(camera):
+        deadline = time.time() + CubotCam.SETTLE_TIMEOUT
+        gains = None
+        readings = 0
+        while time.time() < deadline and readings < CubotCam.GAIN_READINGS:
+            previous = gains
+            gains = (float(camera.analog_gain), float(camera.digital_gain))
+            if previous and all(
+                abs(g - p) <= CubotCam.GAIN_TOLERANCE for (g, p) in zip(gains, previous)
+            ):
+                readings += 1
+            else:
+                readings = 0
+            time.sleep(CubotCam.GAIN_INTERVAL)
+        return gains
+
+    @staticmethod
+    def _lock_exposure(camera, calibration):
+        camera.awb_mode = "off"
+        camera.awb_gains = tuple(calibration["awb_gains"])
+        camera.iso = calibration["iso"]
+        camera.shutter_speed = calibration["shutter_speed"]
+        # The sensor gains cannot be set directly: they converge towards the
+        # requested ISO in a few frames and are frozen by turning exposure off
+        camera.exposure_mode = "auto"
+        gains = CubotCam._wait_for_gains(camera)
+        camera.exposure_mode = "off"
+        return gains
+
+    @staticmethod
+    def load_calibration(calibration_file=CALIBRATION_FILE):
+        if not path.exists(calibration_file):
+            return None
+        with open(calibration_file) as f:
+            return json.load(f)
+
+    def __init__(
+        self, calibration_file=CALIBRATION_FILE, steady_timeout=STEADY_TIMEOUT
+    ):
+        import_vision()
+        self.calibration_file = calibration_file
+        self.steady_timeout = steady_timeout
+        self.calibration = CubotCam.load_calibration(calibration_file)
+        self.cam = CubotCam._init_pi_cam(self.calibration)
+        self._set_perspective(
+            self.calibration["perspective_points"]
+            if self.calibration
+            else CubotCam.PERSPECTIVE_POINTS
+        )
         self.orig_face = None
         self.square_face = None
         self.labels = None
         self.samples = []
+        # Frames are captured in the camera's native YUV420 layout (a full
+        # resolution Y plane followed by quarter resolution U and V planes)
+        # into the same buffer, and only the sampled pixels are ever read
+        self.yuv_buffer = np.empty(
+            (CubotCam.IMG_HEIGHT * CubotCam.IMG_WIDTH * 3 // 2,), dtype=np.uint8
+        )
+        self.yuv_frame = None
+        steady_width, steady_height = CubotCam.STEADY_SIZE
+        self.steady_buffer = np.empty(
+            (steady_width * steady_height * 3 // 2,), dtype=np.uint8
+        )
+        self.wait_times = []
+        self.feed = deque(maxlen=CubotCam.FEED_SIZE)
+        self.feed_ready = threading.Condition()
+        self.feed_thread = None
+        self.feeding = False
+
+    def _set_perspective(self, points):
+        self.perspective_points = points
+        pts1 = np.float32(points)
+        pts2 = np.float32(
+            [
+                [0, 0],
+                [CubotCam.SQUARE_SIZE, 0],
+                [0, CubotCam.SQUARE_SIZE],
+                [CubotCam.SQUARE_SIZE, CubotCam.SQUARE_SIZE],
+            ]
+        )
+        self.perspective = cv2.getPerspectiveTransform(pts1, pts2)
+        self._set_sampling_indices()
+
+    def _set_sampling_indices(self):
+        # Pixels of every sampling circle of the square face, mapped back
+        # through the perspective onto offsets of the Y, U and V planes
+        r = CubotCam.SAMPLING_RADIUS
+        dy, dx = np.mgrid[-r : r + 1, -r : r + 1]
+        disc = dx * dx + dy * dy <= r * r
+        points = np.concatenate(
+            [
+                np.stack([dx[disc] + x, dy[disc] + y], axis=1)
+                for ((x, y), _) in CubotCam.SAMPLING_POINTS
+            ]
+        ).astype(np.float32)
+        orig = cv2.perspectiveTransform(
+            points.reshape((-1, 1, 2)), np.linalg.inv(self.perspective)
+        ).reshape((-1, 2))
+        w, h = CubotCam.IMG_WIDTH, CubotCam.IMG_HEIGHT
+        x = np.clip(np.rint(orig[:, 0]).astype(np.intp), 0, w - 1)
+        y = np.clip(np.rint(orig[:, 1]).astype(np.intp), 0, h - 1)
+        chroma = (y // 2) * (w // 2) + x // 2
+        self.sampling_indices = np.stack(
+            [y * w + x, w * h + chroma, w * h + w * h // 4 + chroma]
+        )
+        self.sampling_size = int(disc.sum())
+        self.sampling_starts = np.arange(
+            0, len(CubotCam.SAMPLING_POINTS) * self.sampling_size, self.sampling_size
+        )
+
+    def calibrate(self, perspective_points=None):
+        print("📷 Calibrating camera...")
+        self.cam.iso = 0
+        self.cam.shutter_speed = 0
+        self.cam.exposure_mode = "auto"
+        self.cam.awb_mode = "auto"
+        time.sleep(CubotCam.SETTLE_TIMEOUT)
+        auto_gain = float(self.cam.analog_gain) * float(self.cam.digital_gain)
+        self.calibration = {
+            "awb_gains": [float(g) for g in self.cam.awb_gains],
+            "shutter_speed": self.cam.exposure_speed,
+            "perspective_points": perspective_points or self.perspective_points,
+        }
+        if not perspective_points:
+            print("📐 Keeping perspective points %s" % self.perspective_points)
+        # The gain an ISO gives depends on the sensor: each ISO is tried at
+        # the measured shutter speed, and the one closest to the automatic
+        # exposure is kept, along with the gains it actually reaches
+        best = None
+        for iso in CubotCam.ISOS:
+            self.calibration["iso"] = iso
+            gains = CubotCam._lock_exposure(self.cam, self.calibration)
+            error = abs(gains[0] * gains[1] - auto_gain)
+            print("ISO %d: analog gain %.2f, digital gain %.2f" % ((iso,) + gains))
+            if best is None or error < best[0]:
+                best = (error, iso)
+        self.calibration["iso"] = best[1]
+        gains = CubotCam._lock_exposure(self.cam, self.calibration)
+        self.calibration["analog_gain"], self.calibration["digital_gain"] = gains
+        with open(self.calibration_file, "w") as f:
+            json.dump(self.calibration, f, indent=2)
+        self._set_perspective(self.calibration["perspective_points"])
+        print("💾 Calibration saved to %s" % self.calibration_file)
 
     def capture(self):
         img = np.empty((CubotCam.IMG_HEIGHT * CubotCam.IMG_WIDTH * 3,), dtype=np.uint8)
         self.cam.capture(img, "bgr")
         self.orig_face = img.reshape((CubotCam.IMG_HEIGHT, CubotCam.IMG_WIDTH, 3))
+        self.yuv_frame = None
+        self._warp()
+
+    def wait_until_steady(self):
+        # Compares the luma of small video frames until two consecutive ones
+        # match, i.e. until the cube and the arm have stopped moving
+        start = time.time()
+        luma_size = CubotCam.STEADY_SIZE[0] * CubotCam.STEADY_SIZE[1]
+        previous = None
+        steady = False
+        while not steady and time.time() - start < self.steady_timeout:
+            self.cam.capture(
+                self.steady_buffer,
+                "yuv",
+                resize=CubotCam.STEADY_SIZE,
+                use_video_port=True,
+            )
+            luma = self.steady_buffer[:luma_size].astype(np.int16)
+            if previous is not None:
+                motion = np.abs(luma - previous).mean()
+                steady = motion < CubotCam.MOTION_THRESHOLD
+            previous = luma
+        elapsed = time.time() - start
+        self.wait_times.append(elapsed)
+        if steady:
+            print("⏱️ Steady after %d ms" % (1000 * elapsed))
+        else:
+            print("❗Still moving after %d ms, capturing anyway" % (1000 * elapsed))
+        return steady
 
-        pts1 = np.float32([[140, 180], [465, 180], [-30, 465], [620, 465]])
-        pts2 = np.float32([[0, 0], [300, 0], [0, 300], [300, 300]])
-        M = cv2.getPerspectiveTransform(pts1, pts2)
-        self.square_face = cv2.warpPerspective(self.orig_face, M, (300, 300))
+    def capture_yuv(self):
+        self.cam.capture(self.yuv_buffer, "yuv")
+        self.yuv_frame = self.yuv_buffer
+        self.orig_face = None
+        self.square_face = None
+
+    @staticmethod
+    def _yuv_to_bgr(y, u, v):
+        # The camera encodes YUV as full range BT.601 (JFIF), which is what
+        # OpenCV calls YCrCb, with the chroma channels in the other order
+        return cv2.cvtColor(cv2.merge([y, v, u]), cv2.COLOR_YCrCb2BGR)
+
+    def decode_frame(self):
+        # Only needed to save a YUV capture: colors are read from the buffer
+        w, h = CubotCam.IMG_WIDTH, CubotCam.IMG_HEIGHT
+        chroma = [
+            cv2.resize(
+                plane.reshape((h // 2, w // 2)), (w, h), interpolation=cv2.INTER_NEAREST
+            )
+            for plane in np.split(self.yuv_frame[w * h :], 2)
+        ]
+        self.orig_face = CubotCam._yuv_to_bgr(
+            self.yuv_frame[: w * h].reshape((h, w)), *chroma
+        )
+        self._warp()
+
+    def _warp(self):
+        self.square_face = cv2.warpPerspective(
+            self.orig_face,
+            self.perspective,
+            (CubotCam.SQUARE_SIZE, CubotCam.SQUARE_SIZE),
+        )
+
+    def start_feed(self):
+        # Keeps the latest video frames around while the cube is moving, so
+        # that a face can be read as soon as it is in place instead of
+        # starting a still capture once everything has stopped
+        if self.feeding:
+            return
+        self.feed.clear()
+        self.feeding = True
+        self.feed_thread = threading.Thread(target=self._run_feed, daemon=True)
+        self.feed_thread.start()
+
+    def stop_feed(self):
+        if not self.feeding:
+            return
+        self.feeding = False
+        self.feed_thread.join()
+        self.feed_thread = None
+
+    def _run_feed(self):
+        img = np.empty((CubotCam.IMG_HEIGHT * CubotCam.IMG_WIDTH * 3,), dtype=np.uint8)
+        frame = img.reshape((CubotCam.IMG_HEIGHT, CubotCam.IMG_WIDTH, 3))
+        for _ in self.cam.capture_continuous(img, "bgr", use_video_port=True):
+            with self.feed_ready:
+                self.feed.append((time.time(), frame.copy()))
+                self.feed_ready.notify_all()
+            if not self.feeding:
+                break
+
+    @staticmethod
+    def _motion(frame1, frame2):
+        step = CubotCam.MOTION_STEP
+        a = frame1[::step, ::step, 1].astype(np.int16)
+        b = frame2[::step, ::step, 1].astype(np.int16)
+        return np.abs(a - b).mean()
+
+    def capture_from_feed(self, after):
+        # Picks the first frame taken after the given time that does not
+        # differ from the previous one, falling back on the latest frame
+        deadline = time.time() + CubotCam.FEED_TIMEOUT
+        frame = None
+        with self.feed_ready:
+            while True:
+                frames = [f for f in self.feed if f[0] >= after]
+                for (_, previous), (_, current) in zip(frames, frames[1:]):
+                    motion = CubotCam._motion(previous, current)
+                    if motion < CubotCam.MOTION_THRESHOLD:
+                        frame = current
+                        break
+                remaining = deadline - time.time()
+                if frame is not None or remaining <= 0:
+                    break
+                self.feed_ready.wait(remaining)
+            if frame is None and self.feed:
+                print("❗No steady frame in the feed, using the latest one")
+                frame = self.feed[-1][1]
+        if frame is None:
+            self.capture()
+            return
+        self.orig_face = frame
+        self.yuv_frame = None
+        self._warp()
 
     def show_preview(self, x, y):
         self.cam.start_preview(
@@ -68,6 +385,17 @@ class CubotCam:
         self.square_face = cv2.imread(path.join(folder, "%s-square.png" % img_name))
         class_file = path.join(folder, "%s-class.txt" % img_name)
         self.labels = open(class_file).read() if path.exists(class_file) else []
+        self.yuv_frame = None
+
+    def load_frame(self, dataset, i, yuv_frames=None):
+        self.orig_face = dataset.orig_frames[i]
+        self.square_face = dataset.square_frames[i]
+        self.labels = dataset.index[i][3]
+        self.yuv_frame = None
+        # Frames recorded along with their raw YUV buffer are named after it
+        name = dataset.index[i][1]
+        if yuv_frames is not None and name.startswith("yuv_"):
+            self.yuv_frame = yuv_frames[int(name[len("yuv_") :])]
 
     @staticmethod
     def _detect_color(hsv):
@@ -84,16 +412,36 @@ class CubotCam:
         else:
             return "R"
 
-    def identify_colors(self):
+    def _sample_yuv(self):
+        # Converts only the pixels of the sampling circles to HSV, and
+        # averages them per circle like _sample_hsv does
+        y, u, v = self.yuv_frame[self.sampling_indices][:, :, None]
+        bgr = CubotCam._yuv_to_bgr(y, u, v)
+        hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV).reshape((-1, 3))
+        sums = np.add.reduceat(hsv.astype(np.uint32), self.sampling_starts, axis=0)
+        return [tuple(float(v) for v in sample / self.sampling_size) for sample in sums]
+
+    def _sample_hsv(self):
         hsv = cv2.cvtColor(self.square_face, cv2.COLOR_BGR2HSV)
-        face_colors = []
-        for (i, (sp, pos)) in enumerate(CubotCam.SAMPLING_POINTS):
+        averages = []
+        for (sp, _) in CubotCam.SAMPLING_POINTS:
             mask = np.zeros(hsv.shape[:2], dtype="uint8")
             cv2.circle(mask, sp, CubotCam.SAMPLING_RADIUS, 255, -1)
-            average = cv2.mean(hsv, mask)
+            averages.append(cv2.mean(hsv, mask)[:3])
+        return averages
+
+    def identify_colors(self):
+        if self.yuv_frame is not None:
+            averages = self._sample_yuv()
+        else:
+            averages = self._sample_hsv()
+        face_colors = []
+        for (i, (average, (_, pos))) in enumerate(
+            zip(averages, CubotCam.SAMPLING_POINTS)
+        ):
             color = CubotCam._detect_color(average)
             face_colors.append(color)
-            sample = average[:3] + (
+            sample = average + (
                 pos,
                 self.labels[i] if self.labels and i < len(self.labels) else "-",
                 color,
@@ -106,10 +454,22 @@ class CubotCam:
         for face in ["U", "R", "F", "D", "L", "B"]:
             self.load_capture("face_%s" % face, folder)
             self.identify_colors()
+        self._print_test_results()
 
+    def test_dataset(self, dataset, run=None, yuv_frames=None):
+        # With the raw buffers of a recorded session, the YUV captures are
+        # tested through the same sampling as DETECT
+        self.samples = []
+        frames = dataset.run_slice(run) if run else slice(0, len(dataset))
+        for i in range(frames.start, frames.stop):
+            self.load_frame(dataset, i, yuv_frames)
+            self.identify_colors()
+        self._print_test_results()
+
+    def _print_test_results(self):
         print("Sorted results")
         print("----------------------------")
-        results = sorted(ccam.samples, key=(lambda x: (x[1] >= 100, x[0])))
+        results = sorted(self.samples, key=(lambda x: (x[1] >= 100, x[0])))
         errors = 0
         for e in results:
             print("%5.1f  %5.1f  %5.1f  %s  %s %s" % e)
@@ -122,11 +482,116 @@ class CubotCam:
 
 class PiCube:
     LEGO_HUB_DEVICE = "/dev/ttyACM0"
-    COMMANDS = {"DETECT", "SOLVE", "IMAGE", "EXIT"}
+    COMMANDS = {
+        "STATUS",
+        "SCANPLAN",
+        "DETECT",
+        "SCAN",
+        "SOLVE",
+        "PLAN",
+        "IMAGE",
+        "EXIT",
+    }
+    # Commands that can only run once a component has warmed up
+    COMPONENTS = {
+        "DETECT": "camera",
+        "SCAN": "camera",
+        "IMAGE": "camera",
+        "SOLVE": "solver",
+        "PLAN": "solver",
+    }
+    # The face can be read once the cube is square with the camera and the
+    # grabbing arm has left the field of view (motor degrees from home)
+    BASE_TOLERANCE = 3
+    ARM_CLEAR_POS = -25
 
-    def __init__(self):
-        self.cubot_cam = CubotCam()
-        self.port = None
+    def __init__(
+        self,
+        capture_format="png",
+        png_compression=1,
+        optimal=False,
+        optimal_time_limit=60,
+        steady_timeout=CubotCam.STEADY_TIMEOUT,
+        cubot_cam=None,
+        port=None,
+    ):
+        self.capture_format = capture_format
+        self.png_compression = png_compression
+        self.steady_timeout = steady_timeout
+        self.cubot_cam = cubot_cam
+        self.capture_writer = None
+        self.planner = MotorPlanner()
+        self.scan_planner = ScanPlanner()
+        self.optimal = optimal
+        self.optimal_solver = OptimalSolver(time_limit=optimal_time_limit)
+        self.near_solved = None
+        self.scan_tracker = ScanTracker()
+        self.solver_executor = ThreadPoolExecutor(max_workers=1)
+        self.speculation = None
+        self.port = port
+        self.capabilities = {"SCANPLAN"}
+        self.ready = {"camera": threading.Event(), "solver": threading.Event()}
+        self.warm_up_errors = {}
+        self.warm_up()
+
+    def warm_up(self):
+        for component, warm_up in [
+            ("camera", self._warm_up_camera),
+            ("solver", self._warm_up_solver),
+        ]:
+            threading.Thread(
+                target=self._run_warm_up, args=(component, warm_up), daemon=True
+            ).start()
+
+    def _run_warm_up(self, component, warm_up):
+        start = time.time()
+        try:
+            self.capabilities.update(warm_up())
+            print("🔥 Warmed up the %s in %.1f s" % (component, time.time() - start))
+        except Exception as e:
+            print("❗Cannot start %s: %s" % (component, e))
+            self.warm_up_errors[component] = str(e)
+        finally:
+            self.ready[component].set()
+
+    def _warm_up_camera(self):
+        from capture import CaptureWriter
+
+        import_vision()
+        if self.cubot_cam is None:
+            self.cubot_cam = CubotCam(steady_timeout=self.steady_timeout)
+        self.cubot_cam.show_preview(1800, 10)
+        self.capture_writer = CaptureWriter(
+            fmt=self.capture_format, png_compression=self.png_compression
+        )
+        return ["DETECT", "SCAN", "IMAGE"]
+
+    def _warm_up_solver(self):
+        from nearsolved import NearSolvedIndex
+
+        import_solver()
+        capabilities = ["SOLVE", "PLAN"]
+        self.near_solved = NearSolvedIndex.load()
+        if self.near_solved:
+            capabilities.append("NEARSOLVED")
+        if self.optimal:
+            self.optimal_solver.load()
+        if self.optimal or self.optimal_solver.has_tables():
+            capabilities.append("OPTIMAL")
+        # The two-phase solver loads its tables on the first solve
+        cube = Cube()
+        cube.apply("R U")
+        solve(str(cube))
+        return capabilities
+
+    def is_ready(self):
+        return all(event.is_set() for event in self.ready.values())
+
+    def wait_for(self, component):
+        if not self.ready[component].is_set():
+            print("⏳ Waiting for the %s to warm up..." % component)
+            self.ready[component].wait()
+        return component not in self.warm_up_errors
 
     def connect(self):
         print("🔌 Connecting to Cubot...")
@@ -166,49 +631,211 @@ class PiCube:
                 self.disconnect()
                 raise e
 
+    def wait_for_alignment(self):
+        # Follows the motor positions streamed by the Hub while the grabbing
+        # arm moves back to rest, until it reports the end of the motion
+        while True:
+            line = self.port.readline().decode("utf-8").strip()
+            if line == "END":
+                return
+            if line.startswith("POS "):
+                base_error, arm_pos = [int(v) for v in line.split()[1:3]]
+                if abs(base_error) <= PiCube.BASE_TOLERANCE and (
+                    arm_pos >= PiCube.ARM_CLEAR_POS
+                ):
+                    return
+
     def send_reponse(self, response):
         self.port.write(bytes(response + "\n\r", "utf-8"))
         print("✔️ Response sent (%s)" % response)
 
     def run(self):
-        self.cubot_cam.show_preview(1800, 10)
         while True:
             command, args = self.wait_for_command()
             print("⚙️ Command received: '%s'" % command)
+            # Commands received during the warm-up wait here, and the ones
+            # that follow them stay queued on the serial port
+            component = PiCube.COMPONENTS.get(command)
+            if component and not self.wait_for(component):
+                self.send_reponse("ERROR %s" % self.warm_up_errors[component])
+                continue
             if command == "EXIT":
                 print("Exiting...")
+                if self.capture_writer:
+                    self.cubot_cam.stop_feed()
+                    self.capture_writer.close()
                 return
+            elif command == "STATUS":
+                self.send_reponse(
+                    "OK %s %s"
+                    % (
+                        "READY" if self.is_ready() else "WARMING",
+                        ",".join(sorted(self.capabilities)) or "-",
+                    )
+                )
             elif command == "IMAGE":
                 img_name = args[0]
                 print("💾 Saving image %s..." % img_name)
+                self.cubot_cam.stop_feed()
                 self.cubot_cam.capture()
-                self.cubot_cam.save_capture(img_name)
-                time.sleep(0.2)
+                self.capture_writer.submit(
+                    img_name, self.cubot_cam.orig_face, self.cubot_cam.square_face
+                )
                 self.send_reponse("OK")
+            elif command == "SCANPLAN":
+                # A new scan starts: whatever was tracked or solved for an
+                # interrupted one is dropped
+                self.reset_scan()
+                plan, cost = self.scan_planner.plan(args[0])
+                print("🗺️ Scan plan from %s (%d ms)" % (args[0], cost))
+                self.send_reponse("OK %s" % " ".join(plan))
             elif command == "DETECT":
                 face = args[0]
                 print("🔎 Detecting colors of face %s..." % face)
-                self.cubot_cam.capture()
+                self.cubot_cam.stop_feed()
+                self.cubot_cam.wait_until_steady()
+                self.cubot_cam.capture_yuv()
+                # The Hub can move on to the next face while the colors are read
+                self.send_reponse("CAPTURED")
                 colors = self.cubot_cam.identify_colors()
-                time.sleep(0.2)
                 self.send_reponse("OK %s" % "".join(colors))
+                if len(args) > 1:
+                    self.track_scan(args[1], "".join(colors))
+            elif command == "SCAN":
+                face = args[0]
+                print("🎥 Scanning face %s on the fly..." % face)
+                self.cubot_cam.start_feed()
+                self.wait_for_alignment()
+                self.cubot_cam.capture_from_feed(time.time())
+                self.send_reponse("CAPTURED")
+                colors = "".join(self.cubot_cam.identify_colors())
+                self.send_reponse("OK %s" % colors)
+                if len(args) > 1:
+                    self.track_scan(args[1], colors)
+                if self.scan_tracker.is_complete():
+                    self.cubot_cam.stop_feed()
             elif command == "SOLVE":
-                conf = args[0]
-                print("🤔 Solving cube %s..." % conf)
-                cube = Cube(conf)
-                cube.print()
-                solution = solve(conf)
+                conf = Cube(args[0]).get_cube_in_canonical_orientation()
+                solution = self.get_solution(conf, "OPTIMAL" in args[1:])
                 print("✉️ Sending solution: %s" % solution)
                 self.send_reponse("OK %s" % solution)
+            elif command == "PLAN":
+                state, faces, last_turn_sense = args[:3]
+                if state.startswith("@"):
+                    # Plan from the state and orientation tracked while
+                    # scanning, once the colors the Hub received (face on top
+                    # and colors of every capture) match the tracked ones
+                    if self.scan_tracker.get_state() is None:
+                        self.send_reponse("ERROR incomplete scan")
+                        continue
+                    if state[1:].split(",") != self.scan_tracker.captures:
+                        print(
+                            "❗Hub scanned %s, tracked %s"
+                            % (state[1:], ",".join(self.scan_tracker.captures))
+                        )
+                        self.reset_scan()
+                        self.send_reponse("ERROR scan mismatch")
+                        continue
+                    conf = None
+                    faces = "".join(self.scan_tracker.cube.faces)
+                else:
+                    conf = Cube(state).get_cube_in_canonical_orientation()
+                solution = self.get_solution(conf, "OPTIMAL" in args[3:])
+                self.planner.reset(faces, last_turn_sense)
+                plan = self.planner.compile(solution)
+                print("✉️ Sending plan for solution: %s" % solution)
+                self.send_reponse(
+                    "OK %s %s %s"
+                    % (self.planner.faces(), self.planner.last_turn(), " ".join(plan))
+                )
+
+    def reset_scan(self):
+        self.scan_tracker.reset()
+        if self.speculation:
+            self.speculation[1].cancel()
+            self.speculation = None
+
+    def track_scan(self, orientation, colors):
+        self.scan_tracker.add_face(orientation, colors)
+        if self.scan_tracker.is_complete():
+            conf = self.scan_tracker.get_state()
+            print("🏃 Solving %s ahead of the Hub..." % conf)
+            self.speculation = (conf, self.solver_executor.submit(self.solve, conf))
+
+    def get_solution(self, conf=None, optimal=False):
+        # Without a state, the one tracked through the scan is solved: it has
+        # been checked against the Hub's colors, and the speculative solution
+        # is used as is
+        if self.speculation:
+            speculative_conf, future = self.speculation
+            self.speculation = None
+            if conf is not None and speculative_conf != conf:
+                print("❗Scanned state %s differs from %s" % (speculative_conf, conf))
+            elif optimal and not self.optimal:
+                future.cancel()
+            else:
+                return future.result()
+        return self.solve(conf or self.scan_tracker.get_state(), optimal)
 
+    def solve(self, conf, optimal=False):
+        if not self.wait_for("solver"):
+            raise Exception(self.warm_up_errors["solver"])
+        print("🤔 Solving cube %s..." % conf)
+        cube = Cube(conf)
+        cube.print()
+        if self.near_solved:
+            solution = self.near_solved.lookup(conf)
+            if solution is not None:
+                print("⚡ Found in the near-solved index")
+                return solution
+        solution = solve(conf)
+        if optimal or self.optimal:
+            print("🔍 Looking for a shorter solution than %s..." % solution)
+            solution = self.optimal_solver.solve(conf, solution)
+        return solution
 
-pi_cube = PiCube()
-if pi_cube.connect():
-    pi_cube.run()
-    pi_cube.disconnect()
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["calibrate"]:
+        # Place a solved cube under the camera, with the white face up. The
+        # corners of the top face can be given as x,y pixel coordinates
+        # (top left, top right, bottom left, bottom right): the current ones
+        # are kept otherwise
+        points = [[int(v) for v in arg.split(",")] for arg in sys.argv[2:]]
+        if points and len(points) != 4:
+            print("Usage: picube.py calibrate [x,y x,y x,y x,y]")
+            sys.exit(2)
+        CubotCam().calibrate(points)
+    elif sys.argv[1:] == ["build-tables"]:
+        OptimalSolver.build_tables()
+    elif sys.argv[1:2] == ["build-index"]:
+        from nearsolved import NearSolvedIndex
+
+        NearSolvedIndex.build(
+            int(sys.argv[2]) if len(sys.argv) > 2 else NearSolvedIndex.DEFAULT_DEPTH
+        )
+    elif sys.argv[1:] in ([], ["--optimal"]):
+        # --optimal looks for the shortest solution of every cube, within
+        # the time limit: build the tables first (build-tables)
+        pi_cube = PiCube(optimal="--optimal" in sys.argv)
+        if pi_cube.connect():
+            pi_cube.run()
+            pi_cube.disconnect()
+    else:
+        print(
+            "Usage: picube.py [--optimal] | calibrate [x,y x,y x,y x,y]"
+            " | build-tables | build-index [depth]"
+        )
+        sys.exit(2)
 
 # While testing the color recognition algorithm...
 # ccam = CubotCam()
 # ccam.test("/home/pi/Pictures/scrambled_1")
 # ccam.test("/home/pi/Pictures/scrambled_2")
 # ccam.test("/home/pi/Pictures/scrambled_3")
+#
+# ...or, once the folders are packed into a dataset:
+# from capture import CaptureDataset
+# dataset = CaptureDataset("/home/pi/Pictures")
+# dataset.import_folder("/home/pi/Pictures/scrambled_1")
+# ccam.test_dataset(dataset, "scrambled_1")
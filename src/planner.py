@@ -0,0 +1,150 @@
+from cube import Cube
+
+
+class MotorPlanner:
+    TURN_RATIO = 3  #  24 / 8
+    VALID_MOVES = {
+        move + variation for move in Cube.FACES for variation in ["", "'", "2"]
+    }
+    ARM_SPEED = 70
+    BASE_SPEED = 80
+    GRAB_POS = -75
+    REST_POS = 0
+    REST_SPEED = 40
+    TURN_OVERSHOOT = 22
+    TURN_BACKLASH = 3
+    NO_TURN = "-"
+    # Rough timing of the plan steps, used to compare plans: the motors turn
+    # about 10 degrees per second for each % of speed, and every step pays
+    # for accelerating and stopping
+    DEGREES_PER_SECOND = 10
+    STEP_OVERHEAD = 40
+    # Typical time for the arm to settle at its target (S steps), as
+    # measured by the Hub
+    SETTLE_TIME = 50
+
+    def __init__(self, faces=None, last_turn_sense=None):
+        self.reset(faces, last_turn_sense)
+
+    def reset(self, faces=None, last_turn_sense=None):
+        self.cube = Cube()
+        if faces:
+            self.cube.faces = list(faces)
+        self.last_turn_sense = (
+            None if last_turn_sense == MotorPlanner.NO_TURN else last_turn_sense
+        )
+        self.arm = None
+        self.plan = []
+
+    @staticmethod
+    def duration(plan, arm_pos=REST_POS):
+        # Estimated time (in ms) to execute a plan, from the given arm position
+        ms = 0
+        for step in plan:
+            if step[0] == "W":
+                ms += int(step[1:])
+                continue
+            if step[0] == "S":
+                ms += MotorPlanner.SETTLE_TIME
+                continue
+            value, speed, _ = step[1:].split(":")
+            if step[0] == "E":
+                degrees = abs(int(value) - arm_pos)
+                arm_pos = int(value)
+            else:
+                degrees = abs(int(value))
+            ms += MotorPlanner.STEP_OVERHEAD + 1000 * degrees / (
+                int(speed) * MotorPlanner.DEGREES_PER_SECOND
+            )
+        return ms
+
+    def faces(self):
+        return "".join(self.cube.faces)
+
+    def last_turn(self):
+        return self.last_turn_sense or MotorPlanner.NO_TURN
+
+    def _arm(self, pos, speed, stop_action):
+        if self.arm == (pos, stop_action):
+            return
+        self.plan.append("E%d:%d:%s" % (pos, speed, stop_action))
+        self.arm = (pos, stop_action)
+
+    def _base(self, degrees, speed=BASE_SPEED):
+        self.plan.append("A%d:%d:h" % (degrees, speed))
+
+    def _settle(self):
+        # The Hub waits until the arm has settled at its last target
+        self.plan.append("S")
+
+    def grab(self):
+        self._arm(MotorPlanner.GRAB_POS, MotorPlanner.ARM_SPEED, "h")
+
+    def rest(self):
+        self._arm(MotorPlanner.REST_POS, MotorPlanner.REST_SPEED, "b")
+
+    def tilt(self):
+        self.grab()
+        self._arm(-155, MotorPlanner.ARM_SPEED, "h")
+        self._settle()
+        self._arm(-55, 100, "h")
+        self._arm(MotorPlanner.GRAB_POS, MotorPlanner.ARM_SPEED, "h")
+        self._settle()
+        self.cube.apply("z")
+
+    def rotate_cube(self, sense, times=1):
+        self.rest()
+        distance_in_degrees = MotorPlanner.TURN_RATIO * 90 * times
+        if sense == "clockwise":
+            distance_in_degrees = -distance_in_degrees
+        self._base(distance_in_degrees)
+        if times % 4 == 1:
+            self.cube.apply("y" if sense == "clockwise" else "y'")
+        elif times % 4 == 3:
+            self.cube.apply("y'" if sense == "clockwise" else "y")
+        elif times % 4 == 2:
+            self.cube.apply("y2")
+
+    def turn_bottom_face(self, sense, times=1):
+        self.grab()
+        distance_in_degrees = MotorPlanner.TURN_RATIO * 90 * times
+        extra_distance = MotorPlanner.TURN_RATIO * MotorPlanner.TURN_OVERSHOOT
+        if self.last_turn_sense and self.last_turn_sense == sense:
+            extra_distance += MotorPlanner.TURN_RATIO * MotorPlanner.TURN_BACKLASH
+        if sense == "counterclockwise":
+            distance_in_degrees = -distance_in_degrees
+            extra_distance = -extra_distance
+        self._base(distance_in_degrees + extra_distance)
+        self._base(-extra_distance)
+        self.last_turn_sense = sense
+
+    @staticmethod
+    def _parse_move(move):
+        sense = "counterclockwise" if move.endswith("'") else "clockwise"
+        times = 2 if move.endswith("2") else 1
+        return move[0], sense, times
+
+    def place_face_down(self, face):
+        if self.cube.get_oriented_face("front") == face:
+            self.rotate_cube("counterclockwise")
+        elif self.cube.get_oriented_face("back") == face:
+            self.rotate_cube("clockwise")
+        elif self.cube.get_oriented_face("left") == face:
+            self.rotate_cube("clockwise", 2)
+        elif self.cube.get_oriented_face("up") == face:
+            self.tilt()
+        if self.cube.get_oriented_face("right") == face:
+            self.tilt()
+
+    def compile(self, moves):
+        mvs = moves.strip().split()
+        for move in mvs:
+            if move not in MotorPlanner.VALID_MOVES:
+                raise ValueError("Invalid move '%s'" % move)
+        for move in mvs:
+            face, sense, times = MotorPlanner._parse_move(move)
+            self.place_face_down(face)
+            self.turn_bottom_face(sense, times)
+        plan = self.plan
+        self.plan = []
+        return plan
@@ -0,0 +1,349 @@
+import json
+import numpy as np
+import os
+import sys
+import threading
+import time
+
+from capture import CaptureDataset, CaptureWriter
+from os import path
+from picube import CubotCam, PiCube, import_vision
+
+SESSIONS_FOLDER = "sessions"
+# Direction of the recorded traffic, as seen from the Pi
+FROM_HUB = "<"
+TO_HUB = ">"
+
+
+def _session_log(session, folder=SESSIONS_FOLDER):
+    return path.join(folder, "%s.log" % session)
+
+
+def _session_yuv(session, folder=SESSIONS_FOLDER):
+    return path.join(folder, "%s-yuv.frames" % session)
+
+
+def _session_camera(session, folder=SESSIONS_FOLDER):
+    return path.join(folder, "%s-camera.json" % session)
+
+
+def load_session(session, folder=SESSIONS_FOLDER):
+    events = []
+    with open(_session_log(session, folder)) as f:
+        for line in f:
+            event = json.loads(line)
+            events.append(
+                (event["t"], event["dir"], event["data"].encode("latin-1"))
+            )
+    return events
+
+
+def load_yuv_frames(session, folder=SESSIONS_FOLDER):
+    size = CubotCam.IMG_HEIGHT * CubotCam.IMG_WIDTH * 3 // 2
+    yuv_file = _session_yuv(session, folder)
+    if not path.exists(yuv_file) or not path.getsize(yuv_file):
+        return np.empty((0, size), dtype=np.uint8)
+    return np.memmap(yuv_file, dtype=np.uint8, mode="r").reshape((-1, size))
+
+
+def load_perspective_points(session, folder=SESSIONS_FOLDER):
+    camera_file = _session_camera(session, folder)
+    if not path.exists(camera_file):
+        return CubotCam.PERSPECTIVE_POINTS
+    with open(camera_file) as f:
+        return json.load(f)["perspective_points"]
+
+
+class SerialRecorder:
+    # Wraps the serial port and logs every chunk of bytes exchanged with the
+    # Hub, with the time elapsed since the start of the session
+    def __init__(self, port, log_file):
+        self.port = port
+        self.log = open(log_file, "x")
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def _record(self, direction, data):
+        if not data:
+            return
+        event = {
+            "t": round(time.time() - self.start, 6),
+            "dir": direction,
+            "data": data.decode("latin-1"),
+        }
+        with self.lock:
+            self.log.write(json.dumps(event) + "\n")
+            self.log.flush()
+
+    def readline(self):
+        data = self.port.readline()
+        self._record(FROM_HUB, data)
+        return data
+
+    def write(self, data):
+        self._record(TO_HUB, data)
+        return self.port.write(data)
+
+    def close(self):
+        self.port.close()
+        self.log.close()
+
+
+class FrameRecorder:
+    # Wraps the camera and saves every frame it captures, in capture order,
+    # so that a replay reads exactly what the Pi saw. The colors of a YUV
+    # capture are read from the raw buffer, which is saved as well
+    def __init__(self, cubot_cam, capture_writer, yuv_file):
+        self.cubot_cam = cubot_cam
+        self.capture_writer = capture_writer
+        self.yuv_log = open(yuv_file, "xb")
+        self.frames = 0
+        self.yuv_frames = 0
+
+    def __getattr__(self, name):
+        return getattr(self.cubot_cam, name)
+
+    def _record(self, name=None):
+        self.capture_writer.submit(
+            name or "frame_%d" % self.frames,
+            self.cubot_cam.orig_face,
+            self.cubot_cam.square_face,
+        )
+        self.frames += 1
+
+    def capture(self):
+        self.cubot_cam.capture()
+        self._record()
+
+    def capture_yuv(self):
+        self.cubot_cam.capture_yuv()
+        self.yuv_log.write(self.cubot_cam.yuv_frame.tobytes())
+        self.yuv_log.flush()
+        self.cubot_cam.decode_frame()
+        # Named after its raw buffer, for the replays and the tests
+        self._record("yuv_%d" % self.yuv_frames)
+        self.yuv_frames += 1
+
+    def close(self):
+        self.yuv_log.close()
+
+    def capture_from_feed(self, after):
+        self.cubot_cam.capture_from_feed(after)
+        self._record()
+
+
+class ReplayCam(CubotCam):
+    # Serves the frames of a recorded session instead of the camera ones.
+    # YUV captures are replayed from their raw buffers, through the same
+    # sampling as on the Pi (sessions recorded without them fall back on
+    # the decoded frames)
+    def __init__(self, dataset, run, yuv_frames, perspective_points):
+        import_vision()
+        self.dataset = dataset
+        if run in dataset.runs():
+            self.frames = dataset.run_slice(run)
+        else:
+            self.frames = slice(0, 0)
+        self.next_frame = self.frames.start
+        self.yuv_frames = yuv_frames
+        self.orig_face = None
+        self.square_face = None
+        self.yuv_frame = None
+        self.labels = None
+        self.samples = []
+        self._set_perspective(perspective_points)
+
+    def _next_frame(self, yuv_frames=None):
+        if self.next_frame >= self.frames.stop:
+            raise Exception("No more recorded frames")
+        self.load_frame(self.dataset, self.next_frame, yuv_frames)
+        self.next_frame += 1
+
+    def capture(self):
+        self._next_frame()
+
+    def capture_yuv(self):
+        self._next_frame(self.yuv_frames)
+
+    def wait_until_steady(self):
+        return True
+
+    def capture_from_feed(self, after):
+        self.capture()
+
+    def start_feed(self):
+        pass
+
+    def stop_feed(self):
+        pass
+
+    def show_preview(self, x, y):
+        pass
+
+    def hide_preview(self):
+        pass
+
+
+class FakeSerial:
+    # Plays the Hub's side of a recorded session: the recorded lines are
+    # delivered at their original time divided by speed (or as soon as they
+    # are read with speed 0), and the Pi responses are checked against the
+    # recorded ones
+    def __init__(self, events, speed=1.0):
+        self.reads = [(t, data) for (t, d, data) in events if d == FROM_HUB]
+        self.writes = [data for (_, d, data) in events if d == TO_HUB]
+        self.speed = speed
+        self.start = time.time()
+        self.next_read = 0
+        self.next_write = 0
+        self.pending = None
+        self.command = None
+        self.latencies = []
+        self.mismatches = []
+
+    def readline(self):
+        if self.next_read >= len(self.reads):
+            # The Hub never stops the Pi on its own: end the replay here
+            return b"EXIT\n"
+        t, data = self.reads[self.next_read]
+        self.next_read += 1
+        if self.speed:
+            delay = self.start + t / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        # The POS and END lines streamed during a SCAN are not commands
+        command = data.split()[0].decode("latin-1") if data.split() else None
+        if command in PiCube.COMMANDS:
+            # The Pi handles the commands one at a time: the responses that
+            # follow belong to this one
+            self.command = command
+            if self.pending is None:
+                self.pending = (command, time.time())
+        return data
+
+    def write(self, data):
+        if self.pending:
+            command, received = self.pending
+            self.latencies.append((command, time.time() - received))
+            self.pending = None
+        expected = None
+        if self.next_write < len(self.writes):
+            expected = self.writes[self.next_write]
+        if self.command == "STATUS":
+            # Whether the Pi has warmed up, and what it can do, depends on
+            # the timing and on what is installed: only the status is checked
+            matches = expected is not None and data.split()[:1] == expected.split()[:1]
+        else:
+            matches = data == expected
+        if not matches:
+            self.mismatches.append((self.next_write, expected, data))
+        self.next_write += 1
+        return len(data)
+
+    def close(self):
+        pass
+
+    def print_report(self):
+        print("Replay results")
+        print("----------------------------")
+        commands = {}
+        for (command, latency) in self.latencies:
+            commands.setdefault(command, []).append(latency)
+        for command, latencies in sorted(commands.items()):
+            print(
+                "%-8s %4d  avg %7.1f ms  max %7.1f ms"
+                % (
+                    command,
+                    len(latencies),
+                    1000 * sum(latencies) / len(latencies),
+                    1000 * max(latencies),
+                )
+            )
+        print("Elapsed: %.2f s" % (time.time() - self.start))
+        print("----------------------------")
+        for (i, expected, data) in self.mismatches:
+            print("Response %d: expected %r, got %r" % (i, expected, data))
+        print("Mismatches:", len(self.mismatches))
+        print("----------------------------")
+
+
+def record(session, folder=SESSIONS_FOLDER):
+    os.makedirs(folder, exist_ok=True)
+    # A session is recorded once: its frames could not be told apart from
+    # the ones of a previous recording under the same name
+    frames = CaptureDataset(folder, session)
+    if path.exists(_session_log(session, folder)) or len(frames):
+        print("❗Session %s already exists" % session)
+        return
+    pi_cube = PiCube()
+    if not pi_cube.connect():
+        return
+    frame_writer = CaptureWriter(
+        folder=folder, fmt="dataset", dataset_name=session, run=session
+    )
+    pi_cube.port = SerialRecorder(pi_cube.port, _session_log(session, folder))
+    pi_cube.wait_for("camera")
+    with open(_session_camera(session, folder), "w") as f:
+        json.dump({"perspective_points": pi_cube.cubot_cam.perspective_points}, f)
+    frame_recorder = FrameRecorder(
+        pi_cube.cubot_cam, frame_writer, _session_yuv(session, folder)
+    )
+    pi_cube.cubot_cam = frame_recorder
+    print("⏺️ Recording session %s..." % session)
+    try:
+        pi_cube.run()
+    finally:
+        frame_writer.close()
+        frame_recorder.close()
+        pi_cube.disconnect()
+
+
+def _replay_cam(session, folder=SESSIONS_FOLDER):
+    return ReplayCam(
+        CaptureDataset(folder, session),
+        session,
+        load_yuv_frames(session, folder),
+        load_perspective_points(session, folder),
+    )
+
+
+def test(session, folder=SESSIONS_FOLDER):
+    # Classifies the frames of a session from their decoded BGR frames, then
+    # as DETECT does, from the raw YUV buffers: errors are counted against
+    # the labels column of the session index, once filled in
+    cubot_cam = _replay_cam(session, folder)
+    print("🎨 Decoded frames")
+    cubot_cam.test_dataset(cubot_cam.dataset, session)
+    print("🎨 Raw YUV buffers")
+    cubot_cam.test_dataset(cubot_cam.dataset, session, cubot_cam.yuv_frames)
+
+
+def replay(session, speed=1.0, folder=SESSIONS_FOLDER):
+    port = FakeSerial(load_session(session, folder), speed)
+    cubot_cam = _replay_cam(session, folder)
+    pi_cube = PiCube(cubot_cam=cubot_cam, port=port)
+    print("⏯️ Replaying session %s..." % session)
+    pi_cube.run()
+    port.print_report()
+    return port.mismatches
+
+
+if __name__ == "__main__":
+    # python replay.py record [session]
+    # python replay.py play <session> [speed]    (speed 0: as fast as possible)
+    # python replay.py test <session>
+    if sys.argv[1:2] == ["record"]:
+        record(sys.argv[2] if len(sys.argv) > 2 else time.strftime("%Y%m%d-%H%M%S"))
+    elif sys.argv[1:2] == ["play"] and len(sys.argv) > 2:
+        mismatches = replay(
+            sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+        )
+        sys.exit(1 if mismatches else 0)
+    elif sys.argv[1:2] == ["test"] and len(sys.argv) > 2:
+        test(sys.argv[2])
+    else:
+        print(
+            "Usage: replay.py record [session] | play <session> [speed]"
+            " | test <session>"
+        )
+        sys.exit(2)
@@ -0,0 +1,69 @@
+from cube import Cube
+
+
+def _whole_cube_rotations():
+    # Shortest move sequence for each of the 24 orientations of the cube
+    rotations = {"".join(Cube.FACES): ""}
+    frontier = [""]
+    while frontier:
+        next_frontier = []
+        for seq in frontier:
+            for move in ["x", "y", "z"]:
+                cube = Cube()
+                cube.apply((seq + " " + move).strip())
+                faces = "".join(cube.faces)
+                if faces not in rotations:
+                    rotations[faces] = (seq + " " + move).strip()
+                    next_frontier.append(rotations[faces])
+        frontier = next_frontier
+    return list(rotations.values())
+
+
+class ScanTracker:
+    ROTATIONS = _whole_cube_rotations()
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.cube = None
+        self.scanned = 0
+        # Face on top and colors of every capture, in capture order
+        self.captures = []
+
+    def is_complete(self):
+        return self.scanned == len(Cube.FACES)
+
+    @staticmethod
+    def _rotation_between(from_faces, to_faces):
+        for rotation in ScanTracker.ROTATIONS:
+            cube = Cube()
+            cube.faces = list(from_faces)
+            if rotation:
+                cube.apply(rotation)
+            if "".join(cube.faces) == to_faces:
+                return rotation
+        raise ValueError("Invalid orientation '%s'" % to_faces)
+
+    def add_face(self, orientation, colors):
+        # Mirrors the Hub's own tracking: the whole-cube rotations done
+        # between two captures are recovered from the orientations the Hub
+        # reports, so the scan order does not need to be known in advance
+        if self.cube is None or self.is_complete():
+            self.cube = Cube()
+            self.cube.faces = list(orientation)
+            self.scanned = 0
+            self.captures = []
+        else:
+            rotation = ScanTracker._rotation_between(self.cube.faces, orientation)
+            if rotation:
+                self.cube.apply(rotation)
+        self.cube.assign_colors_top_face(colors)
+        self.captures.append(orientation[0] + colors)
+        self.scanned += 1
+
+    def get_state(self):
+        if not self.is_complete():
+            return None
+        self.cube.reset_orientation()
+        return self.cube.get_cube_in_canonical_orientation()
@@ -0,0 +1,121 @@
+import heapq
+
+from cube import Cube
+from planner import MotorPlanner
+
+_END = "end"
+
+
+class ScanPlanner:
+    # Time (in ms) to capture a face once the arm is at rest: the same for
+    # every plan, but part of the estimated total
+    CAPTURE_COST = 300
+    MOVES = ["tilt", "clockwise", "counterclockwise", "twice"]
+    ALL_SCANNED = (1 << len(Cube.FACES)) - 1
+    REST = (MotorPlanner.REST_POS, "b")
+
+    def __init__(self):
+        self.plans = {}
+        self.steps = {}
+        self.first_move_costs = {}
+
+    def _step(self, faces, arm, action):
+        # The moves do not depend on the faces already scanned: they are
+        # simulated once for all the searches
+        key = (faces, arm, action)
+        if key not in self.steps:
+            self.steps[key] = ScanPlanner._simulate(faces, arm, action)
+        return self.steps[key]
+
+    @staticmethod
+    def _simulate(faces, arm, action):
+        planner = MotorPlanner(faces)
+        planner.arm = arm
+        if action == "tilt":
+            planner.tilt()
+        elif action == "twice":
+            planner.rotate_cube("clockwise", 2)
+        elif action == "capture":
+            planner.rest()
+        else:
+            planner.rotate_cube(action)
+        start = arm[0] if arm else MotorPlanner.REST_POS
+        return (
+            planner.faces(),
+            planner.arm,
+            planner.plan,
+            MotorPlanner.duration(planner.plan, start),
+        )
+
+    @staticmethod
+    def expected_first_move_cost(faces):
+        # The solution is not known while scanning: any face is as likely to
+        # be turned first, and it has to be placed down and grabbed
+        total = 0
+        for face in Cube.FACES:
+            planner = MotorPlanner(faces)
+            planner.arm = ScanPlanner.REST
+            planner.place_face_down(face)
+            planner.grab()
+            total += MotorPlanner.duration(planner.plan)
+        return total / len(Cube.FACES)
+
+    def _neighbours(self, state):
+        faces, scanned, arm = state
+        if scanned == ScanPlanner.ALL_SCANNED:
+            if faces not in self.first_move_costs:
+                self.first_move_costs[faces] = ScanPlanner.expected_first_move_cost(
+                    faces
+                )
+            yield _END, [], self.first_move_costs[faces]
+            return
+        up = 1 << Cube.FACES.index(faces[0])
+        if not scanned & up:
+            # The Hub rests the arm itself before capturing: only the marker
+            # (face and orientation) goes into the plan
+            _, new_arm, _, cost = self._step(faces, arm, "capture")
+            yield (
+                (faces, scanned | up, new_arm),
+                ["C%s:%s" % (faces[0], faces)],
+                cost + ScanPlanner.CAPTURE_COST,
+            )
+        for move in ScanPlanner.MOVES:
+            new_faces, new_arm, plan, cost = self._step(faces, arm, move)
+            yield (new_faces, scanned, new_arm), plan, cost
+
+    def _search(self, faces):
+        # Dijkstra over (orientation, scanned faces, arm position), with the
+        # expected cost of the first solution move as the cost of ending
+        start = (faces, 0, None)
+        costs = {start: 0}
+        parents = {}
+        queue = [(0, 0, start)]
+        pushed = 1
+        done = set()
+        while queue:
+            cost, _, state = heapq.heappop(queue)
+            if state in done:
+                continue
+            done.add(state)
+            if state == _END:
+                break
+            for (next_state, plan, step_cost) in self._neighbours(state):
+                next_cost = cost + step_cost
+                if next_state not in costs or next_cost < costs[next_state]:
+                    costs[next_state] = next_cost
+                    parents[next_state] = (state, plan)
+                    heapq.heappush(queue, (next_cost, pushed, next_state))
+                    pushed += 1
+
+        steps = []
+        state = _END
+        while state != start:
+            state, plan = parents[state]
+            steps = plan + steps
+        return steps, costs[_END]
+
+    def plan(self, faces):
+        # Plans only depend on the starting orientation: 24 at most
+        if faces not in self.plans:
+            self.plans[faces] = self._search(faces)
+        return self.plans[faces]